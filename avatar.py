@@ -3,45 +3,244 @@
 
 import os
 import sys
+import time
+import shutil
+import sqlite3
+import hashlib
 import logging
 import argparse
+import threading
+import concurrent.futures
 
 import tgcli
 
 logging.basicConfig(stream=sys.stdout, format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)
 
-def export_avatar_peer(tc, peertype, pid, filename):
+class AvatarManifest:
+    '''
+    Record of the avatars exported to a directory, in `avatars.db` there.
+
+    For each peer, the identity of its photo (`photo_id` as given by tg-cli,
+    if any) and the SHA-1 of the downloaded image are kept, so a changed
+    avatar can be told from the member list. Without a photo id, the avatar
+    is downloaded again `max_age` seconds after the last time, and compared
+    by its SHA-1. Images are stored once in `hash/<sha1>.jpg`, and
+    hard-linked to the file name of each peer.
+    '''
+
+    def __init__(self, path, max_age=86400):
+        self.path = path
+        self.max_age = max_age
+        self.hashdir = os.path.join(path, 'hash')
+        if not os.path.isdir(self.hashdir):
+            os.mkdir(self.hashdir)
+        self.db = sqlite3.connect(os.path.join(path, 'avatars.db'))
+        self.db.execute('CREATE TABLE IF NOT EXISTS avatars ('
+            'peer TEXT PRIMARY KEY,' # user#id123
+            'photo_id TEXT,'
+            'sha1 TEXT,'  # NULL if tg-cli failed to load it
+            'filename TEXT,'
+            'error TEXT,'
+            'updated INTEGER'
+        ')')
+        self.db.commit()
+
+    def hashpath(self, sha1):
+        return os.path.join(self.hashdir, sha1 + '.jpg')
+
+    def up_to_date(self, peername, photo_id, filename):
+        '''
+        Whether the avatar of `peername` needn't be downloaded.
+        '''
+        row = self.db.execute('SELECT photo_id, sha1, updated FROM avatars WHERE peer = ?', (peername,)).fetchone()
+        if row is None:
+            if os.path.isfile(filename):
+                # exported before the manifest
+                sha1 = self.store(filename, copy=True)[0]
+                self.link(sha1, filename)
+                self.record(peername, photo_id, sha1, filename)
+                return True
+            return False
+        old_id, sha1, updated = row
+        if photo_id is not None and old_id != photo_id:
+            return False
+        elif photo_id is None and time.time() - updated > self.max_age:
+            # can't tell if it's the same photo
+            return False
+        elif sha1 is None:
+            # tg-cli failed to load it, eg. there is no photo
+            return True
+        elif not os.path.isfile(filename):
+            if not os.path.isfile(self.hashpath(sha1)):
+                return False
+            self.link(sha1, filename)
+        return True
+
+    def get_sha1(self, peername):
+        row = self.db.execute('SELECT sha1 FROM avatars WHERE peer = ?', (peername,)).fetchone()
+        return row and row[0]
+
+    def store(self, src, copy=False):
+        '''
+        Move (or `copy`) the image `src` into the hash directory. Return its
+        SHA-1, and whether the same image was already stored.
+        '''
+        h = hashlib.sha1()
+        with open(src, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+        sha1 = h.hexdigest()
+        dest = self.hashpath(sha1)
+        if os.path.isfile(dest):
+            if not copy:
+                os.remove(src)
+            return sha1, True
+        # tg-cli downloads may be on another file system
+        tmp = '%s.tmp%d' % (dest, threading.get_ident())
+        (shutil.copyfile if copy else shutil.move)(src, tmp)
+        os.replace(tmp, dest)
+        return sha1, False
+
+    def link(self, sha1, filename):
+        if os.path.isfile(filename) and os.path.samefile(self.hashpath(sha1), filename):
+            # rename() does nothing in this case
+            return
+        tmp = filename + '.tmp'
+        if os.path.lexists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(self.hashpath(sha1), tmp)
+        except OSError:
+            # no hard links
+            shutil.copyfile(self.hashpath(sha1), tmp)
+        os.replace(tmp, filename)
+
+    def record(self, peername, photo_id, sha1, filename, error=None):
+        self.db.execute('REPLACE INTO avatars VALUES (?,?,?,?,?,?)',
+            (peername, photo_id, sha1, filename, error, int(time.time())))
+
+    def commit(self):
+        self.db.commit()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+def fetch_avatar(tc, manifest, peertype, pid, attempts=2):
+    '''
+    Download the avatar of a peer into the hash directory. Return the
+    SHA-1, whether it's a duplicate, and the error of tg-cli.
+    '''
     peername = '%s#id%d' % (peertype, pid)
-    if os.path.isfile(filename):
-        logging.info('Avatar exists: ' + peername)
-        return
-    res = getattr(tc, 'cmd_load_%s_photo' % peertype)(peername)
+    for attempt in range(attempts):
+        try:
+            res = getattr(tc, 'cmd_load_%s_photo' % peertype)(peername)
+            break
+        except Exception:
+            # tg-cli died or timed out, it's restarted by itself
+            if attempt == attempts - 1:
+                raise
     if 'result' in res and res['result'] != 'FAIL':
-        os.rename(res['result'], filename)
-        logging.info('Exported avatar for %s' % peername)
-    else:
-        logging.warning('Failed to export avatar for %s: %s' % (peername, res))
+        return manifest.store(res['result']) + (None,)
+    return None, False, res.get('error', str(res))
+
+def export_avatars(tc, items, path, jobs=1, force=False, max_age=86400, load_peers=None):
+    '''
+    Export the avatars of `items` of (peertype, pid, filename, photo_id)
+    with `jobs` concurrent downloads, skipping the ones in the manifest
+    whose photo hasn't changed. `load_peers` is called before downloading
+    any of them.
+    '''
+    manifest = AvatarManifest(path, max_age)
+    todo = []
+    for peertype, pid, filename, photo_id in items:
+        peername = '%s#id%d' % (peertype, pid)
+        if not force and manifest.up_to_date(peername, photo_id, filename):
+            continue
+        todo.append((peertype, pid, filename, photo_id, manifest.get_sha1(peername)))
+    manifest.commit()
+    logging.info('Avatars: %d up to date, %d to download' % (len(items) - len(todo), len(todo)))
+    if todo and load_peers:
+        load_peers()
+    downloaded = duplicates = unchanged = failed = 0
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(fetch_avatar, tc, manifest, item[0], item[1]): item for item in todo}
+        for future in concurrent.futures.as_completed(futures):
+            peertype, pid, filename, photo_id, old_sha1 = futures[future]
+            peername = '%s#id%d' % (peertype, pid)
+            try:
+                sha1, duplicate, error = future.result()
+            except Exception:
+                # not recorded, so the next run tries again
+                logging.exception('Failed to export avatar for %s' % peername)
+                failed += 1
+                continue
+            if sha1 and sha1 == old_sha1:
+                manifest.link(sha1, filename)
+                unchanged += 1
+                logging.info('Avatar not changed for %s' % peername)
+            elif sha1:
+                manifest.link(sha1, filename)
+                downloaded += 1
+                duplicates += duplicate
+                logging.info('Exported avatar for %s' % peername)
+            else:
+                failed += 1
+                logging.warning('Failed to export avatar for %s: %s' % (peername, error))
+            manifest.record(peername, photo_id, sha1, filename, error)
+            if (downloaded + unchanged + failed) % 100 == 0:
+                manifest.commit()
+    manifest.close()
+    logging.info('Avatars: %d downloaded (%d identical to stored ones), %d not changed, %d failed' % (downloaded, duplicates, unchanged, failed))
+
+def tg_members(tc):
+    return getattr(tc, 'members', (tc,))
+
+def send_all(tc, cmd):
+    '''
+    Send `cmd` to every telegram-cli process, bypassing the cache, so that
+    they all know the peers in the answer. Return the first answer.
+    '''
+    return [member.send_command(cmd, cache=False) for member in tg_members(tc)][0]
 
-def export_avatar_group(tc, grouptype, pid, path):
+def get_members(tc, grouptype, pid, cache=True):
+    '''
+    Get the members of a group or channel. Without `cache`, the lists are
+    fetched by every telegram-cli process, so that they know the members.
+    '''
     peername = '%s#id%d' % (grouptype, pid)
     members = {}
+    if cache:
+        send = lambda cmd: tc.send_command(cmd)
+    else:
+        send = lambda cmd: send_all(tc, cmd)
     logging.info('Fetching info for %s' % peername)
     if grouptype == 'channel':
-        items = tc.cmd_channel_get_members(peername, 100)
-        for item in items:
-            members[item['peer_id']] = item
-        dcount = 100
-        while items:
-            items = tc.cmd_channel_get_members(peername, 100, dcount)
+        dcount = 0
+        while True:
+            items = send('channel_get_members %s 100 %d' % (peername, dcount))
+            if not items:
+                break
             for item in items:
                 members[item['peer_id']] = item
             dcount += 100
     else:
-        obj = tc.cmd_chat_info(peername)
+        obj = send('chat_info %s' % peername)
         for item in obj['members']:
             members[item['peer_id']] = item
-    for key in members:
-        export_avatar_peer(tc, 'user', key, os.path.join(path, '%d.jpg' % key))
+    return members
+
+def export_avatar_group(tc, grouptype, pid, path, jobs=1, force=False, max_age=86400):
+    # the cached lists tell which avatars to download, but tg-cli needs
+    # to get the members itself to download them
+    members = get_members(tc, grouptype, pid)
+    items = [('user', key, os.path.join(path, '%d.jpg' % key), item.get('photo_id'))
+             for key, item in members.items()]
+    export_avatars(tc, items, path, jobs, force, max_age,
+                   lambda: get_members(tc, grouptype, pid, cache=False))
+
+def export_avatar_peer(tc, peertype, pid, path, force=False, max_age=86400):
+    export_avatars(tc, [(peertype, pid, os.path.join(path, '%s%d.jpg' % (peertype, pid)), None)], path, force=force, max_age=max_age)
 
 def main(argv):
     parser = argparse.ArgumentParser(description="Export Telegram messages.")
@@ -49,17 +248,35 @@ def main(argv):
     parser.add_argument("-g", "--group", help="export every user's avatar in a group or channel", action='store_true')
     parser.add_argument("-t", "--type", help="peer type, can be 'user', 'chat', 'channel'", default="user")
     parser.add_argument("-i", "--id", help="peer id", type=int)
+    parser.add_argument("-j", "--jobs", help="number of telegram-cli processes to download with", type=int, default=1)
+    parser.add_argument("--profile", help="telegram-cli config directory, copied for each process when using -j (default ~/.telegram-cli)")
+    parser.add_argument("-f", "--force", help="download the avatars again even if they are not changed", action='store_true')
+    parser.add_argument("-a", "--max-age", help="when tg-cli doesn't tell the photo id, download the avatars again after this number of hours to check them", type=float, default=24)
     parser.add_argument("-e", "--tgbin", help="Telegram-cli binary path", default="bin/telegram-cli")
+    parser.add_argument("-c", "--cache", help="cache file for read-only tg-cli queries", default="tg-export3.cache.db")
+    parser.add_argument("--no-cache", help="don't cache tg-cli queries", action='store_true')
+    parser.add_argument("-R", "--refresh", help="refresh cached tg-cli queries", action='store_true')
     args = parser.parse_args(argv)
 
-    with tgcli.TelegramCliInterface(args.tgbin, run=False) as tc:
-        tc.cmd_dialog_list()
+    cache = None
+    if not args.no_cache:
+        cache = tgcli.ResponseCache(args.cache, refresh=args.refresh)
+    jobs = max(1, args.jobs)
+    if jobs > 1:
+        tc = tgcli.TelegramCliPool(args.tgbin, jobs, run=False, profile=args.profile, cache=cache)
+    else:
+        tc = tgcli.TelegramCliInterface(args.tgbin, run=False, cache=cache)
+    with tc:
+        # loads the peers in tg-cli
+        send_all(tc, 'dialog_list')
         if not os.path.isdir(args.output):
             os.mkdir(args.output)
         if args.group:
-            export_avatar_group(tc, args.type, args.id, args.output)
+            export_avatar_group(tc, args.type, args.id, args.output, jobs, args.force, args.max_age * 3600)
         else:
-            export_avatar_peer(tc, args.type, args.id, os.path.join(args.output, '%s%d.jpg' % (args.type, args.id)))
+            export_avatar_peer(tc, args.type, args.id, args.output, args.force, args.max_age * 3600)
+    if cache:
+        cache.close()
 
 if __name__ == '__main__':
     main(sys.argv[1:])
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Micro-benchmarks for tg-export.
+'''
+
+import os
+import sys
+import json
+import time
+import socket
+import sqlite3
+import argparse
+import tempfile
+import threading
+
+import tgcli
+
+class LegacyReader:
+    '''
+    The line-based reader used before `tgcli.AnswerReader`, for comparison.
+    '''
+
+    def __init__(self, sock, ready):
+        self.sock = sock
+        self.ready = ready
+        self.buffer = b''
+
+    def readline(self):
+        while self.ready.is_set():
+            lines = self.buffer.split(b'\n', 1)
+            if len(lines) > 1:
+                self.buffer = lines[1]
+                return lines[0] + b'\n'
+            else:
+                self.buffer += self.sock.recv(1024)
+        raise tgcli.TelegramCliExited('telegram-cli unexpectedly exited.')
+
+    def read_answer(self, resync=True):
+        line = self.readline()
+        while resync and not line.startswith(b'ANSWER '):
+            line = self.readline()
+        size = int(line[7:].decode('ascii'))
+        reply = b''
+        while len(reply) < size:
+            reply += self.readline()
+        return reply
+
+def make_reply(size):
+    '''
+    Make a `history`-like JSON reply of about `size` bytes.
+    '''
+    msg = {
+        'event': 'message', 'id': '0100000029a1b3c4d5e6f7a8', 'flags': 257,
+        'from': {'id': '$010000002b3c4d5e6f7a8b9c', 'peer_type': 'user',
+                 'peer_id': 12345678, 'print_name': 'Some_User'},
+        'to': {'id': '$050000003c4d5e6f7a8b9cad', 'peer_type': 'channel',
+               'peer_id': 1001234567, 'print_name': 'Some_Channel'},
+        'out': False, 'unread': False, 'service': False, 'date': 1460000000,
+        'text': 'Lorem ipsum dolor sit amet, consectetur adipiscing elit.'
+    }
+    one = len(json.dumps(msg)) + 2
+    return json.dumps([msg] * max(1, size // one)).encode('utf-8') + b'\n'
+
+def bench_framing(reader_cls, reply, rounds):
+    server, client = socket.socketpair()
+    ready = threading.Event()
+    ready.set()
+    frame = b'ANSWER %d\n' % len(reply) + reply
+
+    def serve():
+        for _ in range(rounds):
+            server.sendall(frame)
+
+    thread = threading.Thread(target=serve)
+    thread.daemon = True
+    reader = reader_cls(client, ready)
+    start = time.perf_counter()
+    thread.start()
+    for _ in range(rounds):
+        json.loads(reader.read_answer())
+    elapsed = time.perf_counter() - start
+    thread.join()
+    server.close()
+    client.close()
+    return elapsed
+
+def cmd_framing(args):
+    for mb in args.size:
+        reply = make_reply(int(mb * 1048576))
+        total = len(reply) * args.rounds / 1048576
+        print('reply size: %.2f MiB, %d rounds' % (len(reply) / 1048576, args.rounds))
+        results = {}
+        for name, cls in (('legacy', LegacyReader), ('AnswerReader', tgcli.AnswerReader)):
+            elapsed = bench_framing(cls, reply, args.rounds)
+            results[name] = elapsed
+            print('  %-12s %8.3f s %10.2f MiB/s' % (name, elapsed, total / elapsed))
+        print('  speedup: %.1fx' % (results['legacy'] / results['AnswerReader']))
+
+def cmd_export(args):
+    import export
+
+    env = {
+        'SEED': args.seed, 'USERS': args.users, 'CHATS': args.chats,
+        'CHANNELS': args.channels, 'MESSAGES': args.messages,
+        'DELETED': args.deleted, 'LATENCY': args.latency, 'EXIT': args.exit,
+        'STALL': args.stall, 'HALF': args.half, 'EMPTY': args.empty,
+        'STALL_TIME': args.stall_time, 'CRASH_MISSING': int(not args.no_crash)
+    }
+    for k, v in env.items():
+        os.environ['TGFAKE_' + k] = str(v)
+    timing = {}
+
+    def timed(name, func):
+        def wrapped(*a, **kw):
+            start = time.perf_counter()
+            try:
+                return func(*a, **kw)
+            finally:
+                timing[name] = timing.get(name, 0) + time.perf_counter() - start
+        return wrapped
+
+    export.export_text = timed('export_text', export.export_text)
+    export.export_holes = timed('export_holes', export.export_holes)
+    fakecli = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakecli.py')
+    with tempfile.TemporaryDirectory() as tmpdir:
+        dbfile = os.path.join(tmpdir, 'tg-export3.db')
+        argv = ['-e', fakecli, '-d', dbfile, '-t', str(args.timeout)] + args.export_args
+        start = time.perf_counter()
+        export.main(argv)
+        total = time.perf_counter() - start
+        db = sqlite3.connect(dbfile)
+        count = db.execute('SELECT count(*) FROM messages').fetchone()[0]
+        db.close()
+    dialogs = args.users + args.chats + args.channels
+    print('dialogs: %d, messages per dialog: %d, stored: %d' % (dialogs, args.messages, count))
+    for name in ('export_text', 'export_holes'):
+        if name in timing:
+            print('  %-12s %8.3f s' % (name, timing[name]))
+    print('  %-12s %8.3f s %10.1f messages/s' % ('total', total, count / total))
+
+def cmd_plans(args):
+    import export
+    import logfmt
+    import dbschema
+
+    user = tgl_id(1, 1000)
+    chat = tgl_id(2, 2000)
+    queries = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        export.init_db(os.path.join(tmpdir, 'tg-export3.db'))
+        # creates v_messages_raw
+        export.PAYLOADS.enable(export.CONN)
+        export.DB.commit()
+        msg = logfmt.Messages()
+        for table in ('messages', 'v_messages_raw'):
+            msg.msg_table = table
+            sql = {'cols': logfmt.MSG_COLUMNS, 'table': table}
+            queries.append(('peer, %s' % table, logfmt.SQL_PEER_MSGS % dict(sql, order='ASC', limit=''), (user,) * 3))
+            queries.append(('peer last, %s' % table, logfmt.SQL_PEER_MSGS % dict(sql, order='DESC', limit='LIMIT 100'), (user,) * 3))
+            for name, dest in (('user', user), ('chat', chat)):
+                for op in ('<', '>='):
+                    sql, params = msg.context_sql(tgl_id(1, 1001), dest, 1460000000, 100, op, 3)
+                    queries.append(('search context %s %s, %s' % (name, op, table), sql, params))
+        failed = 0
+        for name, sql, params in queries:
+            problems = dbschema.check_plan(export.DB, sql, params, 'idx_messages_')
+            failed += bool(problems)
+            print('%-40s %s' % (name, '; '.join(problems) or 'ok'))
+            if args.verbose:
+                for detail in dbschema.query_plan(export.DB, sql, params):
+                    print('    ' + detail)
+        export.DB.close()
+    print('%d of %d query plans regressed' % (failed, len(queries)))
+    return int(bool(failed))
+
+def tgl_id(peer_type, peer_id):
+    # tgl_peer_id_t.to_id
+    return peer_type << 32 | peer_id
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmarks for tg-export.")
+    subparsers = parser.add_subparsers(dest='bench')
+    sp = subparsers.add_parser('framing', help="tg-cli socket answer parsing throughput")
+    sp.add_argument("-s", "--size", help="reply size in MiB", type=float, nargs='+', default=[0.25, 1, 4])
+    sp.add_argument("-r", "--rounds", help="number of replies", type=int, default=3)
+    sp.set_defaults(func=cmd_framing)
+    sp = subparsers.add_parser('export', help="export.py against the fake telegram-cli (fakecli.py)")
+    sp.add_argument("--seed", help="random seed", type=int, default=1)
+    sp.add_argument("--users", help="number of user dialogs", type=int, default=50)
+    sp.add_argument("--chats", help="number of chats", type=int, default=10)
+    sp.add_argument("--channels", help="number of channels", type=int, default=10)
+    sp.add_argument("--messages", help="messages per dialog", type=int, default=1000)
+    sp.add_argument("--deleted", help="fraction of deleted messages", type=float, default=0.001)
+    sp.add_argument("--latency", help="seconds added to each command", type=float, default=0)
+    sp.add_argument("--exit", help="probability of exiting on a command", type=float, default=0)
+    sp.add_argument("--stall", help="probability of not answering a command", type=float, default=0)
+    sp.add_argument("--half", help="probability of a half answer", type=float, default=0)
+    sp.add_argument("--empty", help="probability of an empty history page", type=float, default=0)
+    sp.add_argument("--stall-time", help="seconds to stall", type=float, default=2)
+    sp.add_argument("--no-crash", help="don't exit on getting deleted messages", action='store_true')
+    sp.add_argument("-t", "--timeout", help="tg-cli command timeout", type=int, default=5)
+    sp.add_argument("export_args", help="extra arguments for export.py (after --)", nargs='*')
+    sp.set_defaults(func=cmd_export)
+    sp = subparsers.add_parser('plans', help="check the query plans of reading messages (exits with 1 if they sort or scan)")
+    sp.add_argument("-v", "--verbose", help="print the query plans", action='store_true')
+    sp.set_defaults(func=cmd_plans)
+    args = parser.parse_args(argv)
+    if not args.bench:
+        parser.print_help()
+        return 1
+    return args.func(args)
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -8,6 +8,8 @@ import sqlite3
 import binascii
 import collections
 
+import dbschema
+
 class tgl_peer_id_t(collections.namedtuple('tgl_peer_id_t', 'peer_type peer_id access_hash')):
     '''
     typedef struct {
@@ -197,4 +199,6 @@ else:
         CUR.execute('REPLACE INTO peerinfo VALUES (?,?,?,?)', (convert_peerid2(pid), ptype, print_name, finished))
 
 DB.commit()
+print('* indexes')
+dbschema.migrate(DB)
 print('Done.')
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Versioned migrations of the tg-export v3 database, used by export.py,
+logfmt.py and dbconvert.py.
+
+The tables are created by these scripts as they always were; a migration
+changes them after that. Migrations are idempotent, so that databases from
+before the `schema_version` table, or interrupted in a migration, can be
+migrated again.
+'''
+
+import sys
+import time
+import sqlite3
+
+def add_peerinfo_columns(cur):
+    # for the incremental export (export.schedule_dialogs)
+    columns = [row[1] for row in cur.execute('PRAGMA table_info(peerinfo)')]
+    for column in ('top_id', 'top_date', 'rank'):
+        if column not in columns:
+            cur.execute('ALTER TABLE peerinfo ADD COLUMN %s INTEGER' % column)
+
+def add_probed_ranges(cur):
+    # for export.skip_probed, a range of probed message ids in a row
+    cur.execute('CREATE TABLE IF NOT EXISTS probed_ranges ('
+        'dest INTEGER,' # tgl_peer_id_t.to_id, access_hash = 0
+        'start_id INTEGER,'
+        'end_id INTEGER,'
+        'status INTEGER,' # PROBE_MISSING or PROBE_FAILED
+        'attempts INTEGER,'
+        'last_probe INTEGER,'
+        'PRIMARY KEY (dest, start_id)'
+    ')')
+    tables = [row[0] for row in cur.execute("SELECT name FROM sqlite_master WHERE type = 'table'")]
+    if 'probed_holes' in tables:
+        cur.execute('INSERT OR IGNORE INTO probed_ranges '
+            'SELECT dest, id, id, status, attempts, last_probe FROM probed_holes')
+        cur.execute('DROP TABLE probed_holes')
+
+MIGRATIONS = (
+    (1, add_peerinfo_columns),
+    # reading the messages of a peer in time order, see logfmt.SQL_PEER_MSGS
+    (2, (
+        'CREATE INDEX IF NOT EXISTS idx_messages_dest ON messages (dest, date, id)',
+        'CREATE INDEX IF NOT EXISTS idx_messages_src ON messages (src, date, id)',
+        # a prefix of idx_messages_dest
+        'DROP INDEX IF EXISTS idx_messages',
+    )),
+    (3, add_probed_ranges),
+)
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
+
+def get_version(db):
+    try:
+        return db.execute('SELECT max(version) FROM schema_version').fetchone()[0] or 0
+    except sqlite3.OperationalError:
+        # no table
+        return 0
+
+def migrate(db):
+    '''
+    Apply the migrations newer than the version of the database `db` (a
+    connection), and commit. Return the versions before and after.
+    '''
+    old = version = get_version(db)
+    if version >= SCHEMA_VERSION:
+        return old, version
+    db.execute('CREATE TABLE IF NOT EXISTS schema_version ('
+        'version INTEGER PRIMARY KEY,'
+        'applied INTEGER' # unix time
+    ')')
+    cur = db.cursor()
+    for version, migration in MIGRATIONS:
+        if version <= old:
+            continue
+        if callable(migration):
+            migration(cur)
+        else:
+            for sql in migration:
+                cur.execute(sql)
+        cur.execute('REPLACE INTO schema_version VALUES (?,?)', (version, int(time.time())))
+        db.commit()
+    return old, version
+
+def query_plan(db, sql, params=()):
+    '''
+    Return the details of the EXPLAIN QUERY PLAN of `sql`.
+    '''
+    return [row[-1] for row in db.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def check_plan(db, sql, params=(), index=None):
+    '''
+    Return the problems of the query plan of `sql`: sorting with a
+    temporary B-tree, scanning a whole table, or not using `index`.
+    '''
+    plan = query_plan(db, sql, params)
+    problems = []
+    for detail in plan:
+        if 'TEMP B-TREE' in detail:
+            problems.append(detail)
+        elif detail.startswith('SCAN ') and ' USING ' not in detail and 'SUBQUERY' not in detail.upper():
+            problems.append(detail)
+    if index and not any(index in detail for detail in plan):
+        problems.append('%s not used' % index)
+    return problems
+
+def main(argv):
+    if not argv:
+        print('usage: %s DATABASE' % sys.argv[0])
+        print('Migrate a tg-export v3 database to schema version %d.' % SCHEMA_VERSION)
+        return 1
+    db = sqlite3.connect(argv[0])
+    old, new = migrate(db)
+    print('Schema version: %d -> %d' % (old, new))
+    db.close()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
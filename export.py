@@ -1,22 +1,30 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import os
 import re
 import sys
 import json
 import time
-import queue
+import zlib
 import random
+import hashlib
 import socket
 import struct
 import sqlite3
+import math
 import logging
 import argparse
+import bisect
 import binascii
 import functools
+import itertools
+import threading
 import collections
+import concurrent.futures
 
 import tgcli
+import dbschema
 
 __version__ = '3.0'
 
@@ -151,10 +159,54 @@ def print_id(obj):
     except KeyError:
         return obj['print_name']
 
+SQL_VIEW_MESSAGES = '''
+    CREATE VIEW IF NOT EXISTS v_messages AS
+    SELECT
+      m.id,
+      srcp.type src_type,
+      (CASE srcp.type WHEN 'user' THEN src-4294967296
+       WHEN 'chat' THEN src-8589934592 ELSE src-21474836480 END) src_id,
+      srcp.print_name src_name,
+      dstp.type dest_type,
+      (CASE dstp.type WHEN 'user' THEN dest-4294967296
+       WHEN 'chat' THEN dest-8589934592 ELSE dest-21474836480 END) dest_id,
+      dstp.print_name dest_name,
+      text, media, date,
+      fwdp.type fwd_src_type,
+      (CASE fwdp.type WHEN 'user' THEN fwd_src-4294967296
+       WHEN 'chat' THEN fwd_src-8589934592
+       ELSE fwd_src-21474836480 END) fwd_src_id,
+      fwdp.print_name fwd_src_name,
+      fwd_date, reply_id, out, unread, service, action, flags
+    FROM %s m
+    LEFT JOIN peerinfo srcp ON src=srcp.id
+    LEFT JOIN peerinfo dstp ON dest=dstp.id
+    LEFT JOIN peerinfo fwdp ON fwd_src=fwdp.id
+'''
+
+# messages with the references to payloads (see PayloadStore) resolved
+SQL_VIEW_MESSAGES_RAW = '''
+    CREATE VIEW IF NOT EXISTS v_messages_raw AS
+    SELECT
+      id, src, dest,
+      (CASE WHEN typeof(text) = 'blob' THEN coalesce(
+       (SELECT data FROM payloads WHERE ref=m.text), text) ELSE text END) text,
+      (CASE WHEN typeof(media) = 'blob' THEN coalesce(
+       (SELECT data FROM payloads WHERE ref=m.media), media) ELSE media END) media,
+      date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags
+    FROM messages m
+'''
+
 def init_db(filename):
     global DB, CONN
-    DB = sqlite3.connect(filename)
+    # export_dialogs may write from several threads, serialized by DB_LOCK
+    DB = sqlite3.connect(filename, check_same_thread=False)
     CONN = DB.cursor()
+    # WAL with synchronous=NORMAL doesn't lose committed transactions
+    # when the process is killed, and makes commits cheap
+    CONN.execute('PRAGMA journal_mode=WAL')
+    CONN.execute('PRAGMA synchronous=NORMAL')
+    CONN.execute('PRAGMA cache_size=-65536')
     CONN.execute('CREATE TABLE IF NOT EXISTS messages ('
         'id INTEGER,'   # can be not unique in channels
         'src INTEGER,'  # tgl_peer_id_t.to_id
@@ -201,10 +253,23 @@ def init_db(filename):
         'id INTEGER PRIMARY KEY,' # tgl_peer_id_t.to_id
         'type TEXT,'
         'print_name TEXT,'
-        'finished INTEGER'
+        'finished INTEGER,'
+        'top_id INTEGER,'   # newest message id seen
+        'top_date INTEGER,' # and its date
+        'rank INTEGER'      # position in dialog_list when last exported
+    ')')
+    CONN.execute('CREATE TABLE IF NOT EXISTS blob_dicts ('
+        'id INTEGER PRIMARY KEY,'
+        'data BLOB' # zlib preset dictionary of JsonCodec
+    ')')
+    CONN.execute('CREATE TABLE IF NOT EXISTS resync ('
+        'peer INTEGER,' # tgl_peer_id_t.to_id
+        'start_id INTEGER,'
+        'end_id INTEGER,'
+        'digest TEXT,'
+        'checked INTEGER,'
+        'PRIMARY KEY (peer, start_id)'
     ')')
-    CONN.execute('CREATE INDEX IF NOT EXISTS idx_messages ON '
-        'messages (dest)')
     try:
         CONN.execute('CREATE INDEX IF NOT EXISTS idx_users ON '
             'users (id+4294967296, username)')
@@ -215,38 +280,19 @@ def init_db(filename):
     except sqlite3.OperationalError:
         # < 3.9.0
         pass
-    CONN.execute('''
-    CREATE VIEW IF NOT EXISTS v_messages AS
-    SELECT
-      m.id,
-      srcp.type src_type,
-      (CASE srcp.type WHEN 'user' THEN src-4294967296
-       WHEN 'chat' THEN src-8589934592 ELSE src-21474836480 END) src_id,
-      srcp.print_name src_name,
-      dstp.type dest_type,
-      (CASE dstp.type WHEN 'user' THEN dest-4294967296
-       WHEN 'chat' THEN dest-8589934592 ELSE dest-21474836480 END) dest_id,
-      dstp.print_name dest_name,
-      text, media, date,
-      fwdp.type fwd_src_type,
-      (CASE fwdp.type WHEN 'user' THEN fwd_src-4294967296
-       WHEN 'chat' THEN fwd_src-8589934592
-       ELSE fwd_src-21474836480 END) fwd_src_id,
-      fwdp.print_name fwd_src_name,
-      fwd_date, reply_id, out, unread, service, action, flags
-    FROM messages m
-    LEFT JOIN peerinfo srcp ON src=srcp.id
-    LEFT JOIN peerinfo dstp ON dest=dstp.id
-    LEFT JOIN peerinfo fwdp ON fwd_src=fwdp.id
-    ''')
+    dbschema.migrate(DB)
+    PAYLOADS.load(CONN)
+    CONN.execute(SQL_VIEW_MESSAGES % ('v_messages_raw' if PAYLOADS.enabled else 'messages'))
+    PEER_CACHE.load(CONN)
+    CODEC.load(CONN)
+    SEARCH.load(CONN)
 
-def update_peer(peer):
-    global PEER_CACHE
+def peer_rows(peer):
+    '''
+    Return (pid, table, row, peerinfo row) to be stored for `peer`.
+    '''
     pst = tgl_peer_id_t.from_peer(peer)
     pid = pst.to_id()
-    res = PEER_CACHE.get(pid)
-    if res:
-        return peer
     if 'peer_type' in peer:
         peer_type = peer['peer_type']
     else:
@@ -256,52 +302,586 @@ def update_peer(peer):
     else:
         peer_id = peer['id']
     if peer_type == 'user':
-        CONN.execute('REPLACE INTO users VALUES (?,?,?,?,?,?,?)', (peer_id, pst.access_hash, peer.get('phone'), peer.get('username'), peer.get('first_name'), peer.get('last_name'), peer.get('flags')))
+        table = 'users'
+        row = (peer_id, pst.access_hash, peer.get('phone'), peer.get('username'), peer.get('first_name'), peer.get('last_name'), peer.get('flags'))
     elif peer_type == 'chat':
-        CONN.execute('REPLACE INTO chats VALUES (?,?,?,?,?)', (peer_id, pst.access_hash, peer.get('title'), peer.get('members_num'), peer.get('flags')))
+        table = 'chats'
+        row = (peer_id, pst.access_hash, peer.get('title'), peer.get('members_num'), peer.get('flags'))
     elif peer_type == 'channel':
-        CONN.execute('REPLACE INTO channels VALUES (?,?,?,?,?,?,?)', (peer_id, pst.access_hash, peer.get('title'), peer.get('participants_count'), peer.get('admins_count'), peer.get('kicked_count'), peer.get('flags')))
-    # not support encr_chat
-    if CONN.execute('SELECT print_name FROM peerinfo WHERE id = ?', (pid,)).fetchone():
-        CONN.execute('UPDATE peerinfo SET print_name = ? WHERE id = ?', (peer.get('print_name'), pid))
+        table = 'channels'
+        row = (peer_id, pst.access_hash, peer.get('title'), peer.get('participants_count'), peer.get('admins_count'), peer.get('kicked_count'), peer.get('flags'))
     else:
-        CONN.execute('INSERT INTO peerinfo VALUES (?,?,?,?)', (pid, peer_type, peer.get('print_name'), 0))
-    PEER_CACHE[pid] = peer
+        # not support encr_chat
+        table = row = None
+    return pid, table, row, (pid, peer_type, peer.get('print_name'))
+
+class PeerCache:
+    '''
+    Write-back cache of the stored peers.
+
+    A content hash of the rows of each peer is kept, so that a peer is only
+    written when its fields have changed. Changed peers are marked dirty
+    and written by `flush`, which is called before each commit.
+    '''
+    SQL_TABLE = {
+        'users': 'REPLACE INTO users VALUES (?,?,?,?,?,?,?)',
+        'chats': 'REPLACE INTO chats VALUES (?,?,?,?,?)',
+        'channels': 'REPLACE INTO channels VALUES (?,?,?,?,?,?,?)',
+    }
+    SQL_LOAD = {
+        'users': 'SELECT p.id, p.type, p.print_name, t.* FROM peerinfo p JOIN users t ON p.id = t.id+4294967296',
+        'chats': 'SELECT p.id, p.type, p.print_name, t.* FROM peerinfo p JOIN chats t ON p.id = t.id+8589934592',
+        'channels': 'SELECT p.id, p.type, p.print_name, t.* FROM peerinfo p JOIN channels t ON p.id = t.id+21474836480',
+        None: "SELECT id, type, print_name FROM peerinfo WHERE type NOT IN ('user', 'chat', 'channel')",
+    }
+
+    def __init__(self, maxlen=100000):
+        self.hashes = LRUCache(maxlen)
+        self.dirty = {}
+
+    def load(self, cur):
+        '''
+        Get the hashes of the peers already in the database.
+        '''
+        for table, sql in self.SQL_LOAD.items():
+            for pid, peer_type, print_name, *row in cur.execute(sql):
+                if len(self.hashes.cache) >= self.hashes.capacity:
+                    return
+                self.hashes[pid] = hash((table, tuple(row) if table else None, (pid, peer_type, print_name)))
+
+    def update(self, peer):
+        pid, *rows = peer_rows(peer)
+        h = hash(tuple(rows))
+        if self.hashes.get(pid) == h:
+            return False
+        self.hashes[pid] = h
+        self.dirty[pid] = rows
+        return True
+
+    def flush(self, cur, pid=None):
+        '''
+        Write the dirty peers (or only `pid`) to the database.
+        '''
+        if pid is None:
+            dirty = list(self.dirty.values())
+            self.dirty.clear()
+        elif pid in self.dirty:
+            dirty = [self.dirty.pop(pid)]
+        else:
+            return
+        tables = collections.defaultdict(list)
+        for table, row, info in dirty:
+            if table:
+                tables[table].append(row)
+        for table, rows in tables.items():
+            cur.executemany(self.SQL_TABLE[table], rows)
+        # keep `finished` of existing peers
+        cur.executemany('INSERT OR IGNORE INTO peerinfo (id, type, print_name, finished) VALUES (?,?,?,0)', [info for table, row, info in dirty])
+        cur.executemany('UPDATE peerinfo SET print_name = ? WHERE id = ?', [(info[2], info[0]) for table, row, info in dirty])
+
+def update_peer(peer):
+    PEER_CACHE.update(peer)
     return peer
 
+class CommitPolicy:
+    '''
+    Group commit: commit when `max_msgs` messages have been written or
+    `interval` seconds have passed since the last commit.
+    '''
+
+    def __init__(self, max_msgs=1000, interval=10):
+        self.max_msgs = max_msgs
+        self.interval = interval
+        self.pending = 0
+        self.last = time.monotonic()
+
+    def add(self, n):
+        self.pending += n
+
+    def due(self):
+        return (self.pending >= self.max_msgs or
+                (self.pending and time.monotonic() - self.last >= self.interval))
+
+    def done(self):
+        self.pending = 0
+        self.last = time.monotonic()
+
+def commit():
+    PEER_CACHE.flush(CONN)
+    DB.commit()
+    COMMIT.done()
+
+def maybe_commit(item=None, pos=None):
+    '''
+    Commit if it's due. If `item` is given, its progress marker `pos` is
+    committed along with its messages.
+    '''
+    if COMMIT.due():
+        if item is not None:
+            set_finished(item, pos)
+        commit()
+
 def is_finished(peer):
-    res = CONN.execute('SELECT finished FROM peerinfo WHERE id = ?', (tgl_peer_id_t.from_peer(peer).to_id(),)).fetchone()
+    pid = tgl_peer_id_t.from_peer(peer).to_id()
+    PEER_CACHE.flush(CONN, pid)
+    res = CONN.execute('SELECT finished FROM peerinfo WHERE id = ?', (pid,)).fetchone()
     return res and res[0]
 
 def set_finished(peer, pos):
-    CONN.execute('UPDATE peerinfo SET finished = ? WHERE id = ?', (pos, tgl_peer_id_t.from_peer(peer).to_id()))
+    pid = tgl_peer_id_t.from_peer(peer).to_id()
+    PEER_CACHE.flush(CONN, pid)
+    CONN.execute('UPDATE peerinfo SET finished = ? WHERE id = ?', (pos, pid))
+
+def set_top(item, msglist):
+    '''
+    Store the newest message id and date in the history page `msglist`.
+    '''
+    if not isinstance(msglist, list) or not msglist:
+        return
+    top_id = max((getmsgid(msg, 'id') for msg in msglist), default=None)
+    top_date = max((msg.get('date', 0) for msg in msglist), default=None)
+    pid = tgl_peer_id_t.from_peer(item).to_id()
+    PEER_CACHE.flush(CONN, pid)
+    CONN.execute('UPDATE peerinfo SET top_id = max(ifnull(top_id, 0), ?), '
+        'top_date = max(ifnull(top_date, 0), ?) WHERE id = ?', (top_id, top_date, pid))
+
+def set_ranks(items, ranks):
+    '''
+    Store the positions in dialog_list of the exported `items`.
+    '''
+    PEER_CACHE.flush(CONN)
+    CONN.executemany('UPDATE peerinfo SET rank = ? WHERE id = ?',
+        [(ranks.get(item['id']), tgl_peer_id_t.from_peer(item).to_id()) for item in items])
+
+def schedule_dialogs(dlist):
+    '''
+    Return the dialogs in `dlist` (as returned by dialog_list, newest first)
+    that may have new messages since the last export, the ones never
+    exported or with the oldest top message first.
+
+    A dialog with a new message moves to the top of dialog_list, so the
+    dialogs not changed are in the longest tail of the list still in the
+    order of last time, except its first one, which can have new messages
+    without moving. Dialogs that got new messages in the reverse of their
+    old order are in that tail too, as its first ones, so the tail is
+    checked from there with `has_new_messages` until an unchanged one.
+    '''
+    PEER_CACHE.flush(CONN)
+    info = {}
+    for item in dlist:
+        info[item['id']] = CONN.execute('SELECT rank, top_date FROM peerinfo WHERE id = ?',
+            (tgl_peer_id_t.from_peer(item).to_id(),)).fetchone() or (None, None)
+    start = len(dlist)
+    last = None
+    for k in range(len(dlist) - 1, -1, -1):
+        rank = info[dlist[k]['id']][0]
+        if rank is None or (last is not None and rank >= last):
+            break
+        last = rank
+        start = k
+    changed = dlist[:start + 1]
+    for item in dlist[start + 1:]:
+        if not has_new_messages(item):
+            break
+        changed.append(item)
+    changed.sort(key=lambda item: (info[item['id']][1] is not None, info[item['id']][1] or 0))
+    return changed
+
+def has_new_messages(item):
+    '''
+    Whether the newest message of `item` is newer than its stored top.
+    '''
+    top_id = get_top(item)
+    if not top_id:
+        return True
+    try:
+        msglist = TGCLI.cmd_history(print_id(item), 1)
+    except Exception:
+        logging.exception('Failed to check %s for new messages' % item.get('print_name'))
+        return True
+    if not isinstance(msglist, list) or not msglist:
+        return True
+    return count_above(msglist, top_id) > 0
 
 def reset_finished():
     CONN.execute('UPDATE peerinfo SET finished = 0')
 
+class JsonCodec:
+    '''
+    Encoding of the media and action columns.
+
+    Without a dictionary (the default), values are stored as JSON text.
+    Once a dictionary is trained on the database (`--compact`), they are
+    stored as compact JSON, and the ones of at least `min_size` bytes as
+    BLOBs of raw deflate data compressed with the dictionary:
+
+        b'\\x00' + struct.pack('<H', dict_id) + deflate(json)
+
+    Smaller ones are not worth the time to decompress them when rendering.
+    The dictionaries are kept in `blob_dicts`, and are never changed, so
+    `logfmt.py` can decode the values.
+    '''
+    re_token = re.compile(r'"(?:[^"\\]|\\.)*"\s*:?|[-0-9.eE]+|true|false|null')
+    # the keys in json-tg.c, for databases with few samples
+    SEED = ('{"type":"photo","caption":"', '{"type":"document","caption":"',
+        '{"type":"geo","longitude":', ',"latitude":', '"type":"contact","phone":"',
+        '"first_name":"', '"last_name":"', '"user_id":', '"type":"webpage","url":"',
+        '"title":"', '"description":"', '"author":"', '"address":"', '"provider":"',
+        '"venue_id":"', '{"type":"chat_add_user","user":{', '{"type":"chat_del_user","user":{',
+        '{"type":"chat_rename","title":"', '{"type":"chat_created","title":"',
+        '"peer_type":"user","peer_id":', '"print_name":"', '"flags":', '"username":"',
+        '"phone":"', '{"id":"$')
+    HEADER = b'\x00'
+
+    def __init__(self, min_size=256, level=9):
+        self.min_size = min_size
+        self.level = level
+        self.dicts = {}
+        self.dict_id = None
+
+    def load(self, cur):
+        for dict_id, data in cur.execute('SELECT id, data FROM blob_dicts ORDER BY id'):
+            self.dicts[dict_id] = data
+            self.dict_id = dict_id
+
+    def train(self, values, size=4096):
+        '''
+        Make a dictionary of the most frequent tokens of JSON `values`, the
+        more useful ones at the end, where they are cheaper to refer to.
+        '''
+        counter = collections.Counter()
+        for value in values:
+            counter.update(t for t in self.re_token.findall(value) if len(t) > 3)
+        counter.update({t: 2 for t in self.SEED})
+        tokens = sorted((t for t, n in counter.items() if n > 1),
+                        key=lambda t: counter[t] * len(t), reverse=True)
+        result = []
+        length = 0
+        for token in tokens:
+            data = token.encode('utf-8')
+            if length + len(data) > size:
+                break
+            result.append(data)
+            length += len(data)
+        return b''.join(reversed(result))
+
+    def enable(self, cur, samples=10000, batch=10000):
+        '''
+        Train and store a dictionary on the values in the database, and
+        re-encode them, `batch` messages at a time.
+        '''
+        values = [row[0] for row in cur.execute(
+            "SELECT value FROM (SELECT media value FROM messages "
+            "WHERE typeof(media) = 'text' UNION ALL SELECT action FROM messages "
+            "WHERE typeof(action) = 'text') ORDER BY random() LIMIT ?", (samples,))]
+        data = self.train(values)
+        cur.execute('INSERT INTO blob_dicts (data) VALUES (?)', (data,))
+        self.dict_id = cur.lastrowid
+        self.dicts[self.dict_id] = data
+        count = last = 0
+        while True:
+            rows = cur.execute("SELECT rowid, media, action FROM messages "
+                "WHERE rowid > ? AND (typeof(media) = 'text' OR typeof(action) = 'text') "
+                "ORDER BY rowid LIMIT ?", (last, batch)).fetchall()
+            if not rows:
+                break
+            cur.executemany('UPDATE messages SET media = ?, action = ? WHERE rowid = ?',
+                [(self.recode(media), self.recode(action), rowid) for rowid, media, action in rows])
+            count += len(rows)
+            last = rows[-1][0]
+        return count
+
+    def recode(self, value):
+        if value is None or isinstance(value, bytes):
+            return value
+        return self.encode(json.loads(value))
+
+    def encode(self, obj):
+        if self.dict_id is None:
+            return json.dumps(obj)
+        text = json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+        data = text.encode('utf-8')
+        if len(data) < self.min_size:
+            return text
+        c = zlib.compressobj(self.level, zlib.DEFLATED, -15, zdict=self.dicts[self.dict_id])
+        blob = self.HEADER + struct.pack('<H', self.dict_id) + c.compress(data) + c.flush()
+        if len(blob) >= len(data):
+            return text
+        return blob
+
+    def decode(self, value):
+        '''
+        Return the JSON text of a stored value.
+        '''
+        if not isinstance(value, bytes):
+            return value
+        dict_id = struct.unpack('<H', value[1:3])[0]
+        d = zlib.decompressobj(-15, zdict=self.dicts[dict_id])
+        return (d.decompress(value[3:]) + d.flush()).decode('utf-8')
+
+class PayloadStore:
+    '''
+    Content-addressed storage of the text and media values (`--dedup`).
+
+    Once enabled, values of more than `min_size` bytes are stored once in
+    `payloads`, and `messages` has a reference to them instead:
+
+        b'\\x01' + sha1(b't' + text or b'b' + blob)
+
+    `v_messages_raw` has the columns of `messages` with the references
+    resolved, and `v_messages` is based on it.
+    '''
+    HEADER = b'\x01'
+
+    def __init__(self, min_size=128, maxlen=100000):
+        self.min_size = min_size
+        self.enabled = False
+        # references known to be stored
+        self.known = LRUCache(maxlen)
+        self.pending = {}
+
+    def load(self, cur):
+        self.enabled = cur.execute("SELECT 1 FROM sqlite_master WHERE "
+            "type = 'table' AND name = 'payloads'").fetchone() is not None
+
+    def enable(self, cur, batch=10000):
+        '''
+        Create the table and views, and move the existing values to
+        `payloads`, `batch` messages at a time. Return the number of
+        messages changed.
+        '''
+        cur.execute('CREATE TABLE IF NOT EXISTS payloads ('
+            'ref BLOB PRIMARY KEY,'
+            'data'
+        ') WITHOUT ROWID')
+        cur.execute(SQL_VIEW_MESSAGES_RAW)
+        cur.execute('DROP VIEW IF EXISTS v_messages')
+        cur.execute(SQL_VIEW_MESSAGES % 'v_messages_raw')
+        self.enabled = True
+        count = last = 0
+        while True:
+            rows = cur.execute("SELECT rowid, text, media FROM messages "
+                "WHERE rowid > ? AND (typeof(text) = 'text' OR typeof(media) IN ('text', 'blob')) "
+                "ORDER BY rowid LIMIT ?", (last, batch)).fetchall()
+            if not rows:
+                break
+            updates = []
+            for rowid, text, media in rows:
+                row = (self.ref(text), self.ref(media), rowid)
+                if row[:2] != (text, media):
+                    updates.append(row)
+            self.flush(cur)
+            cur.executemany('UPDATE messages SET text = ?, media = ? WHERE rowid = ?', updates)
+            count += len(updates)
+            last = rows[-1][0]
+        return count
+
+    def ref(self, value):
+        '''
+        Return what is stored in `messages` for `value`.
+        '''
+        if not self.enabled or value is None:
+            return value
+        if isinstance(value, bytes):
+            if value.startswith(self.HEADER):
+                return value
+            data = b'b' + value
+        else:
+            data = b't' + value.encode('utf-8')
+        if len(data) <= self.min_size:
+            return value
+        ref = self.HEADER + hashlib.sha1(data).digest()
+        if self.known.get(ref) is None:
+            self.pending[ref] = value
+        return ref
+
+    def flush(self, cur):
+        '''
+        Store the values referred to since the last flush.
+        '''
+        if not self.pending:
+            return
+        cur.executemany('INSERT OR IGNORE INTO payloads VALUES (?,?)', self.pending.items())
+        for ref in self.pending:
+            self.known[ref] = True
+        self.pending.clear()
+
+    def prune(self, cur):
+        '''
+        Delete the values no longer referred to, eg. after messages are
+        edited or deleted. Return the number deleted.
+        '''
+        if not self.enabled:
+            return 0
+        cur.execute('DELETE FROM payloads WHERE ref NOT IN ('
+            "SELECT text FROM messages WHERE typeof(text) = 'blob' UNION ALL "
+            "SELECT media FROM messages WHERE typeof(media) = 'blob')")
+        self.known = LRUCache(self.known.capacity)
+        return cur.rowcount
+
+class SearchIndex:
+    '''
+    FTS5 index of the text, media caption and sender name of the messages
+    (`--fts`), with the rowid of `messages`.
+
+    It uses the trigram tokenizer if available, which matches substrings
+    like `LIKE '%...%'` does, also in languages without spaces.
+    '''
+    SQL_ADD = ('INSERT INTO messages_fts (rowid, text, caption, sender) '
+        'SELECT rowid, ?, ?, ? FROM messages WHERE id = ? AND dest IS ?')
+    SQL_REMOVE = ('DELETE FROM messages_fts WHERE rowid IN '
+        '(SELECT rowid FROM messages WHERE id = ? AND dest IS ?)')
+    # a column with its reference to payloads resolved, as in v_messages_raw,
+    # whose rowids are NULL
+    SQL_RESOLVE = ("(CASE WHEN typeof(m.{0}) = 'blob' THEN coalesce("
+        "(SELECT data FROM payloads WHERE ref=m.{0}), m.{0}) ELSE m.{0} END)")
+
+    def __init__(self):
+        self.enabled = False
+
+    def load(self, cur):
+        self.enabled = cur.execute("SELECT 1 FROM sqlite_master WHERE "
+            "type = 'table' AND name = 'messages_fts'").fetchone() is not None
+
+    def enable(self, cur):
+        '''
+        Create the index, and add the messages already in the database.
+        Return the number of messages indexed.
+        '''
+        tokenizer = 'trigram' if sqlite3.sqlite_version_info >= (3, 34, 0) else 'unicode61'
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING "
+            "fts5(text, caption, sender, tokenize='%s')" % tokenizer)
+        self.enabled = True
+        return self.backfill(cur)
+
+    def backfill(self, cur, batch=1000):
+        cur.execute('DELETE FROM messages_fts')
+        count = 0
+        rows = []
+        if PAYLOADS.enabled:
+            cols = (self.SQL_RESOLVE.format('text'), self.SQL_RESOLVE.format('media'))
+        else:
+            cols = ('m.text', 'm.media')
+        # a separate cursor, as `cur` is used for writing
+        for row in DB.cursor().execute('SELECT m.rowid, %s, %s, p.print_name '
+            'FROM messages m LEFT JOIN peerinfo p ON m.src = p.id' % cols):
+            rowid, text, media, sender = row
+            caption = None
+            if media is not None:
+                caption = json.loads(CODEC.decode(media)).get('caption')
+            rows.append((rowid, text, caption, sender))
+            if len(rows) >= batch:
+                cur.executemany('INSERT INTO messages_fts (rowid, text, caption, sender) VALUES (?,?,?,?)', rows)
+                count += len(rows)
+                rows = []
+        cur.executemany('INSERT INTO messages_fts (rowid, text, caption, sender) VALUES (?,?,?,?)', rows)
+        return count + len(rows)
+
+    def remove(self, cur, keys):
+        '''
+        Remove the messages of (id, dest) `keys`, before they are replaced
+        or deleted.
+        '''
+        if self.enabled:
+            cur.executemany(self.SQL_REMOVE, keys)
+
+    def add(self, cur, msgs):
+        if not self.enabled:
+            return
+        rows = []
+        for msg in msgs:
+            caption = msg['media'].get('caption') if 'media' in msg else None
+            sender = msg['from'].get('print_name') if 'from' in msg else None
+            rows.append((msg.get('text'), caption, sender, getmsgid(msg, 'id'), getpeerid(msg, 'to')))
+        cur.executemany(self.SQL_ADD, rows)
+
+def msg_row(msg):
+    return (getmsgid(msg, 'id'), getpeerid(msg, 'from'), getpeerid(msg, 'to'), PAYLOADS.ref(msg.get('text')), PAYLOADS.ref(CODEC.encode(msg['media'])) if 'media' in msg else None, msg.get('date'), getpeerid(msg, 'fwd_from'), msg.get('fwd_date'), getmsgid(msg, 'reply_id'), msg.get('out'), msg.get('unread'), msg.get('service'), CODEC.encode(msg['action']) if 'action' in msg else None, msg.get('flags'))
+
+if sqlite3.sqlite_version_info >= (3, 24, 0):
+    SQL_UPSERT_MSG = ('INSERT INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) '
+        'ON CONFLICT(id, dest) DO UPDATE SET src=excluded.src, text=excluded.text, '
+        'media=excluded.media, date=excluded.date, fwd_src=excluded.fwd_src, '
+        'fwd_date=excluded.fwd_date, reply_id=excluded.reply_id, out=excluded.out, '
+        'unread=excluded.unread, service=excluded.service, action=excluded.action, '
+        'flags=excluded.flags')
+else:
+    SQL_UPSERT_MSG = 'REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'
+
+def existing_msgs(dest, ids):
+    '''
+    Return the subset of message `ids` already stored for `dest`.
+    '''
+    ids = list(ids)
+    found = set()
+    # keep below SQLITE_MAX_VARIABLE_NUMBER (999 before 3.32.0)
+    for k in range(0, len(ids), 900):
+        chunk = ids[k:k+900]
+        if dest is None:
+            sql = 'SELECT id FROM messages WHERE dest IS NULL AND id IN (%s)'
+            params = chunk
+        else:
+            sql = 'SELECT id FROM messages WHERE dest = ? AND id IN (%s)'
+            params = [dest] + chunk
+        found.update(row[0] for row in CONN.execute(sql % ','.join('?' * len(chunk)), params))
+    return found
+
+def update_msg_peers(msgs):
+    '''
+    Update each distinct peer in a list of messages once.
+    '''
+    peers = {}
+    for msg in msgs:
+        for key in ('from', 'to', 'fwd_from'):
+            if key in msg:
+                peers[getpeerid(msg, key)] = msg[key]
+    for peer in peers.values():
+        update_peer(peer)
+
+def log_msgs(msgs):
+    '''
+    Store a list of messages (eg. a history page), return the number of
+    messages that were not in the database before.
+    '''
+    update_msg_peers(msgs)
+    # existence is checked with the id as given by tg-cli, as it always was
+    # (in the test branch it is a tgl_message_id_t string, never found)
+    dests = [getpeerid(msg, 'to') for msg in msgs]
+    bydest = collections.defaultdict(list)
+    for dest, msg in zip(dests, msgs):
+        bydest[dest].append(msg['id'])
+    seen = set()
+    for dest, ids in bydest.items():
+        seen.update((dest, mid) for mid in existing_msgs(dest, ids))
+    hit = 0
+    rows = []
+    written = []
+    for dest, msg in zip(dests, msgs):
+        key = (dest, msg['id'])
+        ret = key not in seen
+        seen.add(key)
+        hit += ret
+        # there can be messages like {"event": "message", "id": 561865}
+        # empty messages can be written, and overwritten
+        # json-tg.c:424  if (!(M->flags & TGLMF_CREATED)) { return res; }
+        if ret or 'flags' in msg:
+            rows.append(msg_row(msg))
+            written.append(msg)
+    PAYLOADS.flush(CONN)
+    SEARCH.remove(CONN, [(row[0], row[2]) for row in rows])
+    CONN.executemany(SQL_UPSERT_MSG, rows)
+    SEARCH.add(CONN, written)
+    COMMIT.add(len(rows))
+    return hit
+
 def log_msg(msg):
-    if 'from' in msg:
-        update_peer(msg['from'])
-    if 'to' in msg:
-        update_peer(msg['to'])
-    if 'fwd_from' in msg:
-        update_peer(msg['fwd_from'])
-    ret = not CONN.execute('SELECT 1 FROM messages WHERE id = ? AND dest = ?', (msg['id'], getpeerid(msg, 'to'))).fetchone()
-    # there can be messages like {"event": "message", "id": 561865}
-    # empty messages can be written, and overwritten
-    # json-tg.c:424  if (!(M->flags & TGLMF_CREATED)) { return res; }
-    if ret or 'flags' in msg:
-        CONN.execute('REPLACE INTO messages VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (getmsgid(msg, 'id'), getpeerid(msg, 'from'), getpeerid(msg, 'to'), msg.get('text'), json.dumps(msg['media']) if 'media' in msg else None, msg.get('date'), getpeerid(msg, 'fwd_from'), msg.get('fwd_date'), getmsgid(msg, 'reply_id'), msg.get('out'), msg.get('unread'), msg.get('service'), json.dumps(msg['action']) if 'action' in msg else None, msg.get('flags')))
-    return ret
+    return bool(log_msgs((msg,)))
 
 def process(obj):
     if isinstance(obj, list):
         if not obj:
             return (False, 0)
-        hit = 0
-        for msg in obj:
-            hit += log_msg(msg)
-        return (True, hit)
+        return (True, log_msgs(obj))
     elif isinstance(obj, dict):
         msg = obj
         if msg.get('event') in ('message', 'service', 'read'):
@@ -312,7 +892,7 @@ def process(obj):
             update_peer(msg['peer'])
         elif msg.get('result') == 'FAIL':
             if 'can not parse' in msg.get('error', ''):
-                TGCLI.cmd_dialog_list()
+                TGCLI.cmd_dialog_list(cache=False)
                 #raise ValueError(msg.get('error'))
             return (False, 0)
         return (None, None)
@@ -321,17 +901,128 @@ def process(obj):
         raise ValueError('empty line received')
     return (None, None)
 
+class EventQueue:
+    '''
+    Queue of the events printed by tg-cli, with a high-water mark.
+
+    Above `high_water` events, updates of peers are coalesced (only the
+    last one of each peer is kept) and the events not stored are dropped.
+    With `block` set, `put` waits for the stored events while there are
+    `maxsize` events, which in turn blocks tg-cli from printing more.
+    '''
+    STORED = frozenset(('message', 'service', 'read'))
+
+    def __init__(self, maxsize=10000, high_water=0.8):
+        self.maxsize = maxsize
+        self.high_water = int(maxsize * high_water)
+        self.block = False
+        self.cond = threading.Condition()
+        # (time, event)
+        self.events = collections.deque()
+        # peer id -> (time, event)
+        self.peers = collections.OrderedDict()
+        self.dropped = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def peer_key(obj):
+        if obj.get('event') == 'online-status' and 'user' in obj:
+            return getpeerid(obj, 'user')
+        elif 'peer' in obj and 'event' not in obj:
+            return getpeerid(obj, 'peer')
+
+    def put(self, batch):
+        now = time.monotonic()
+        dropped = self.dropped
+        with self.cond:
+            for obj in batch:
+                if (len(self.events) >= self.high_water
+                    and isinstance(obj, dict) and obj.get('event') not in self.STORED):
+                    key = self.peer_key(obj)
+                    if key is None:
+                        self.dropped += 1
+                        continue
+                    if key in self.peers:
+                        self.coalesced += 1
+                        del self.peers[key]
+                    self.peers[key] = (now, obj)
+                    continue
+                if self.block and len(self.events) >= self.maxsize:
+                    self.cond.notify_all()
+                    self.cond.wait_for(lambda: not self.block or len(self.events) < self.maxsize)
+                self.events.append((now, obj))
+            self.cond.notify_all()
+            dropped = self.dropped - dropped
+        if dropped:
+            logging.warning('Event queue above high water, %d events dropped.' % dropped)
+
+    def get(self, maxitems=1000, timeout=None):
+        '''
+        Return a list of up to `maxitems` events, and the seconds the oldest
+        one has waited. Wait for at most `timeout` seconds for an event.
+        '''
+        with self.cond:
+            if timeout:
+                self.cond.wait_for(self.qsize, timeout)
+            items = []
+            while self.events and len(items) < maxitems:
+                items.append(self.events.popleft())
+            while self.peers and len(items) < maxitems:
+                items.append(self.peers.popitem(last=False)[1])
+            self.cond.notify_all()
+        lag = time.monotonic() - min(t for t, obj in items) if items else 0
+        return [obj for t, obj in items], lag
+
+    def qsize(self):
+        return len(self.events) + len(self.peers)
+
+    def set_block(self, block):
+        with self.cond:
+            self.block = block
+            self.cond.notify_all()
+
 def purge_queue():
     while 1:
-        try:
-            process(MSG_Q.get_nowait())
-        except queue.Empty:
+        events, lag = MSG_Q.get()
+        if not events:
             break
+        for d in events:
+            process(d)
+
+class LazyFormat:
+    '''
+    `logging_fmt(msg)`, formatted only when logged.
+    '''
+    __slots__ = ('msg',)
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return logging_fmt(self.msg)
+
+def write_events(stop, maxitems=1000):
+    '''
+    Store the events in MSG_Q in batches until `stop` is set and MSG_Q is
+    empty. Run in the writer thread of the logging mode.
+    '''
+    while True:
+        events, lag = MSG_Q.get(maxitems, COMMIT.interval)
+        if not events and stop.is_set():
+            break
+        with DB_LOCK:
+            new = 0
+            for d in events:
+                logging.info('%s', LazyFormat(d))
+                new += process(d)[1] or 0
+            maybe_commit()
+        PROGRESS.add(new)
+        PROGRESS.set_queue(MSG_Q.qsize(), lag, MSG_Q.dropped, MSG_Q.coalesced)
 
 def on_start():
     logging.info('Telegram-cli started.')
     time.sleep(2)
-    TGCLI.cmd_dialog_list()
+    TGCLI.cmd_dialog_list(cache=False)
     logging.info('Telegram-cli is ready.')
 
 def logging_fmt(msg):
@@ -364,46 +1055,476 @@ def logging_status(pos, end=False, seg=1000, length=None):
             sys.stdout.write('\n')
     sys.stdout.flush()
 
+class PageSize:
+    '''
+    Adaptive size of history pages.
+
+    The size is doubled while full pages are returned faster than
+    `target / 2` seconds, halved when a page takes more than `target`
+    seconds, and limited to the number of messages tg-cli returns at once.
+    '''
+
+    def __init__(self, size=100, minsize=20, maxsize=1000, target=5):
+        self.size = size
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.target = target
+
+    def update(self, seconds, count, limit):
+        if limit != self.size:
+            return
+        if seconds > self.target:
+            self.size = max(self.minsize, self.size // 2)
+        elif 0 < count < limit:
+            # tg-cli may return less than asked, even if there are more
+            self.size = max(self.minsize, min(self.size, count))
+        elif count >= limit and seconds < self.target / 2:
+            self.size = min(self.maxsize, self.size * 2)
+
+class Progress:
+    '''
+    Progress and throughput of an export run, for monitoring.
+
+    Rates are measured over the last `window` seconds. The status can be
+    written to a file as JSON periodically.
+    '''
+
+    def __init__(self, window=60):
+        self.lock = threading.Lock()
+        self.window = window
+        self.started = time.time()
+        self.phase = None
+        self.phase_started = None
+        self.messages = 0
+        self.pages = 0
+        self.peers_total = 0
+        self.peers_done = 0
+        self.peers_pages = 0
+        self.holes_total = 0
+        self.holes_done = 0
+        self.retries = 0
+        self.queue = (0, 0, 0, 0)
+        # print_name -> offset
+        self.current = {}
+        self.failed = {}
+        self.samples = collections.deque()
+        self.dump_thread = None
+
+    def set_phase(self, phase, total=0):
+        with self.lock:
+            self.phase = phase
+            self.phase_started = time.time()
+            if phase == 'dialogs':
+                self.peers_total = total
+                self.peers_done = self.peers_pages = 0
+            elif phase == 'holes':
+                self.holes_total = total
+                self.holes_done = 0
+            self.samples.clear()
+            self._sample()
+
+    def _sample(self):
+        now = time.monotonic()
+        self.samples.append((now, self.messages, self.pages, self.peers_done, self.holes_done))
+        while len(self.samples) > 2 and now - self.samples[1][0] > self.window:
+            self.samples.popleft()
+
+    def page(self, item, pos, new):
+        with self.lock:
+            self.messages += new
+            self.pages += 1
+            self.peers_pages += 1
+            self.current[item['print_name']] = pos
+            self._sample()
+
+    def peer_done(self, item, failed_pos=None):
+        with self.lock:
+            name = item['print_name']
+            self.current.pop(name, None)
+            if failed_pos is None:
+                self.failed.pop(name, None)
+                self.peers_done += 1
+            else:
+                if name in self.failed:
+                    self.retries += 1
+                self.failed[name] = failed_pos
+            self._sample()
+
+    def hole(self):
+        with self.lock:
+            self.holes_done += 1
+            self._sample()
+
+    def hole_retry(self, count):
+        with self.lock:
+            self.retries += count
+
+    def add(self, new):
+        with self.lock:
+            self.messages += new
+            self._sample()
+
+    def set_queue(self, depth, lag, dropped, coalesced):
+        with self.lock:
+            self.queue = (depth, lag, dropped, coalesced)
+
+    def rates(self):
+        '''
+        Return the rates of (messages, pages, peers, holes) per second.
+        '''
+        if len(self.samples) < 2:
+            return (0, 0, 0, 0)
+        first, last = self.samples[0], self.samples[-1]
+        seconds = max(last[0] - first[0], 1e-6)
+        return tuple((b - a) / seconds for a, b in zip(first[1:], last[1:]))
+
+    def eta(self, rates):
+        if self.phase == 'dialogs':
+            # assume the remaining dialogs take as many pages as the done ones
+            left = self.peers_total - self.peers_done
+            if left <= 0:
+                return 0
+            if self.peers_done and rates[1]:
+                return left * self.peers_pages / self.peers_done / rates[1]
+            elif rates[2]:
+                return left / rates[2]
+        elif self.phase == 'holes' and rates[3]:
+            return (self.holes_total - self.holes_done) / rates[3]
+        return None
+
+    def snapshot(self):
+        with self.lock:
+            rates = self.rates()
+            return {
+                'time': time.time(),
+                'elapsed': time.time() - self.started,
+                'phase': self.phase,
+                'phase_elapsed': time.time() - self.phase_started if self.phase_started else None,
+                'messages': self.messages,
+                'pages': self.pages,
+                'messages_per_second': rates[0],
+                'pages_per_second': rates[1],
+                'peers_total': self.peers_total,
+                'peers_done': self.peers_done,
+                'holes_total': self.holes_total,
+                'holes_done': self.holes_done,
+                'eta': self.eta(rates),
+                'current': dict(self.current),
+                'failed': dict(self.failed),
+                'retries': self.retries,
+                'queue': self.queue[0],
+                'queue_lag': self.queue[1],
+                'queue_dropped': self.queue[2],
+                'queue_coalesced': self.queue[3]
+            }
+
+    def dump(self, filename):
+        '''
+        Write the status as JSON to `filename` atomically, or as a line to
+        stdout if it's '-'.
+        '''
+        status = json.dumps(self.snapshot(), sort_keys=True)
+        if filename == '-':
+            sys.stdout.write(status + '\n')
+            sys.stdout.flush()
+            return
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(status + '\n')
+        os.replace(tmpname, filename)
+
+    def start_dump(self, filename, interval=10):
+        '''
+        Dump the status to `filename` every `interval` seconds.
+        '''
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(filename)
+                except Exception:
+                    logging.exception('Failed to write status.')
+
+        self.dump_thread = threading.Thread(target=dump_loop)
+        self.dump_thread.daemon = True
+        self.dump_thread.start()
+
+def history_pages(item, pos, pages):
+    '''
+    Yield (page, step) of the history of `item` from `pos`, fetching
+    `PIPELINE` pages of `pages.size` at a time. `step` is how far the
+    offset advances after this page.
+    '''
+    while True:
+        limit = pages.size
+        start = time.monotonic()
+        if PIPELINE > 1:
+            batch = TGCLI.send_commands(['history %s %d %d' % (print_id(item), limit, pos + k * limit) for k in range(PIPELINE)], depth=PIPELINE)
+        else:
+            batch = (TGCLI.cmd_history(print_id(item), limit, pos),)
+        seconds = (time.monotonic() - start) / len(batch)
+        for msglist in batch:
+            count = len(msglist) if isinstance(msglist, list) else 0
+            pages.update(seconds, count, limit)
+            step = count if 0 < count < limit else limit
+            yield msglist, step
+            pos += step
+            if step != limit:
+                # the offsets of the rest of the batch are wrong
+                break
+
+def get_top(item):
+    res = CONN.execute('SELECT top_id FROM peerinfo WHERE id = ?', (tgl_peer_id_t.from_peer(item).to_id(),)).fetchone()
+    return res and res[0]
+
+def count_above(msglist, top_id):
+    '''
+    Return the number of messages in `msglist` newer than `top_id`.
+    '''
+    if not isinstance(msglist, list):
+        return 0
+    return sum(1 for msg in msglist if (getmsgid(msg, 'id') or 0) > top_id)
+
 def export_for(item, pos=0, force=False):
     logging.info('Exporting messages for %s from %d' % (item['print_name'], pos))
+    with DB_LOCK:
+        top_id = get_top(item)
+    pages = PageSize()
+    # with a top of last time, its new top is only stored after getting all
+    # the messages above it, and the offsets are only valid after that
+    catching_up = False
     try:
-        # Get the first 100
+        res = (True, 0)
+        new = 0
+        # Get the recently updated messages until the newest one of last
+        # time, or until overlapped
         if not pos:
-            update_peer(item)
-            msglist = TGCLI.cmd_history(print_id(item), 100)
-            res = process(msglist)
-            logging_status(pos)
-            pos = 100
-        else:
-            res = (True, 0)
-        # Get the recently updated messages until overlapped
-        while res[0] is True and not res[1]:
-            msglist = TGCLI.cmd_history(print_id(item), 100, pos)
-            res = process(msglist)
-            logging_status(pos)
-            pos += 100
+            catching_up = bool(top_id)
+            newest = None
+            with DB_LOCK:
+                update_peer(item)
+            for msglist, step in history_pages(item, pos, pages):
+                with DB_LOCK:
+                    res = process(msglist)
+                    if not pos:
+                        newest = msglist
+                        if not top_id:
+                            set_top(item, msglist)
+                    maybe_commit()
+                PROGRESS.page(item, pos, res[1] or 0)
+                logging_status(pos)
+                pos += step
+                if res[0] is not True:
+                    if msglist == []:
+                        # the end of the history
+                        catching_up = False
+                    break
+                elif top_id:
+                    above = count_above(msglist, top_id)
+                    new += above
+                    if above < len(msglist):
+                        catching_up = False
+                        break
+                elif res[1] < len(msglist):
+                    break
+            if catching_up:
+                # failed before the old top, start from the newest one next time
+                logging_status(pos, True)
+                return
+            elif top_id:
+                with DB_LOCK:
+                    set_top(item, newest)
         # If force, then continue
         if not force:
-            pos = max(pos, is_finished(item))
+            with DB_LOCK:
+                finished = is_finished(item) or 0
+            if top_id:
+                # the offset of last time moved by the new messages
+                pos = max(pos, finished + new)
+            else:
+                pos = max(pos, finished)
         # Else, get messages from the offset of last time
         # Until no message is returned (may be not true)
-        while res[0] is True:
-            msglist = TGCLI.cmd_history(print_id(item), 100, pos)
-            res = process(msglist)
-            logging_status(pos)
-            pos += 100
+        if res[0] is True:
+            for msglist, step in history_pages(item, pos, pages):
+                with DB_LOCK:
+                    res = process(msglist)
+                    if res[0] is True:
+                        maybe_commit(item, pos + step)
+                PROGRESS.page(item, pos, res[1] or 0)
+                logging_status(pos)
+                pos += step
+                if res[0] is not True:
+                    break
     except Exception:
         logging_status(pos, True)
-        if pos > is_finished(item):
-            set_finished(item, pos)
+        if catching_up:
+            # the messages above the top of last time are not all stored
+            return 0
+        with DB_LOCK:
+            if pos > is_finished(item):
+                set_finished(item, pos)
         return pos
     logging_status(pos, True)
-    set_finished(item, pos)
+    with DB_LOCK:
+        set_finished(item, pos)
+
+def find_holes(ids, minv=1):
+    '''
+    Yield the missing ranges (start, end) in the sorted iterable `ids`.
+    '''
+    prev = minv - 1
+    for n in ids:
+        if n > prev + 1:
+            yield (prev + 1, n - 1)
+        prev = max(prev, n)
+
+if sqlite3.sqlite_version_info >= (3, 25, 0):
+    SQL_HOLES = ('SELECT prev + 1, id - 1 FROM ('
+        'SELECT id, LAG(id, 1, 0) OVER (ORDER BY id) prev FROM messages '
+        "WHERE %s AND typeof(id) = 'integer') WHERE id > prev + 1")
+else:
+    SQL_HOLES = None
+
+def hole_ranges(where, params=()):
+    '''
+    Yield the missing message id ranges (start, end) of the messages
+    matching `where`, without loading all the ids.
+    '''
+    # use another cursor, so that CONN can be used while iterating
+    cur = DB.cursor()
+    if SQL_HOLES:
+        yield from cur.execute(SQL_HOLES % where, params)
+    else:
+        yield from find_holes(row[0] for row in cur.execute(
+            "SELECT id FROM messages WHERE %s AND typeof(id) = 'integer' "
+            "ORDER BY id" % where, params))
+
+PROBE_MISSING = 1
+PROBE_FAILED = 2
+# the error of get_message for a missing message, if tg-cli doesn't exit
+# (see fakecli.py with TGFAKE_CRASH_MISSING=0)
+PROBE_NOT_FOUND = 'no such message'
+
+def probe_skipped(dest, now):
+    '''
+    Yield the sorted ranges (start, end) of message ids of `dest` not to be
+    probed now: the ones known not to exist, and the failed ones in their
+    backoff time.
+    '''
+    if REPROBE:
+        return
+    # see hole_ranges
+    yield from DB.cursor().execute(
+        'SELECT start_id, end_id FROM probed_ranges WHERE dest = ? AND (status = ? OR '
+        'last_probe + min(?, ? << (attempts - 1)) > ?) ORDER BY start_id',
+        (dest, PROBE_MISSING, PROBE_BACKOFF_MAX, PROBE_BACKOFF, now))
+
+def record_probe(msg, status, missing_after=None):
+    '''
+    Record the outcome of probing `msg`, forget it if it's found.
+    With `missing_after`, a failed message is taken as missing after
+    failing that many times.
+    '''
+    dest = tgl_peer_id_t(msg.peer_type, msg.peer_id, 0).to_id()
+    mid = msg.id
+    attempts = 0
+    row = CONN.execute('SELECT start_id, end_id, status, attempts, last_probe FROM probed_ranges '
+        'WHERE dest = ? AND start_id <= ? ORDER BY start_id DESC LIMIT 1', (dest, mid)).fetchone()
+    if row and row[1] >= mid:
+        # take the id out of its range
+        start, end, old_status, attempts, last_probe = row
+        CONN.execute('DELETE FROM probed_ranges WHERE dest = ? AND start_id = ?', (dest, start))
+        if start < mid:
+            CONN.execute('INSERT INTO probed_ranges VALUES (?,?,?,?,?,?)',
+                (dest, start, mid - 1, old_status, attempts, last_probe))
+        if mid < end:
+            CONN.execute('INSERT INTO probed_ranges VALUES (?,?,?,?,?,?)',
+                (dest, mid + 1, end, old_status, attempts, last_probe))
+    if status is None:
+        return
+    attempts += 1
+    if missing_after and attempts >= missing_after:
+        status = PROBE_MISSING
+    now = int(time.time())
+    # the ids of a hole are probed in order, so extend the range before
+    prev = CONN.execute('SELECT start_id FROM probed_ranges '
+        'WHERE dest = ? AND start_id < ? AND end_id = ? AND status = ? AND attempts = ? '
+        'ORDER BY start_id DESC LIMIT 1', (dest, mid, mid - 1, status, attempts)).fetchone()
+    if prev:
+        CONN.execute('UPDATE probed_ranges SET end_id = ?, last_probe = ? '
+            'WHERE dest = ? AND start_id = ?', (mid, now, dest, prev[0]))
+    else:
+        CONN.execute('INSERT INTO probed_ranges VALUES (?,?,?,?,?,?)',
+            (dest, mid, mid, status, attempts, now))
+
+def skip_probed(holes):
+    '''
+    Remove the ids not to be probed from the list of
+    (peer_type, peer_id, access_hash, start, end), sorted by start for each
+    peer, return the new list and the number of ids removed.
+    '''
+    now = int(time.time())
+    result = []
+    count = 0
+    for dest, group in itertools.groupby(holes, lambda h: tgl_peer_id_t(h[0], h[1], 0).to_id()):
+        skipped = probe_skipped(dest, now)
+        skip = next(skipped, None)
+        for peer_type, peer_id, access_hash, start, end in group:
+            while skip and skip[1] < start:
+                skip = next(skipped, None)
+            while skip and skip[0] <= end:
+                if skip[0] > start:
+                    result.append((peer_type, peer_id, access_hash, start, skip[0] - 1))
+                count += min(end, skip[1]) - max(start, skip[0]) + 1
+                start = skip[1] + 1
+                if start > end:
+                    # may cover the next holes
+                    break
+                skip = next(skipped, None)
+            if start <= end:
+                result.append((peer_type, peer_id, access_hash, start, end))
+    return result, count
 
-def find_holes(minv, maxv, s):
-    for n in range(minv, maxv + 1):
-        if n not in s:
-            yield n
+def expand_holes(holes):
+    '''
+    Yield a tgl_message_id_t for each id in the list of
+    (peer_type, peer_id, access_hash, start, end).
+    '''
+    for peer_type, peer_id, access_hash, start, end in holes:
+        for n in range(start, end + 1):
+            yield tgl_message_id_t(peer_type, peer_id, n, access_hash)
+
+def probe_hole(msg):
+    '''
+    Try to get `msg` with get_message, return True if found, False if it
+    may not exist. Other errors are raised.
+    '''
+    # may be str or int, depending on TG_TEST
+    mid = msg.dumps() if TG_TEST else msg.id
+    try:
+        answer = TGCLI.send_command('get_message %s' % mid)
+        res = process(answer)
+    except tgcli.TelegramCliExited:
+        # interface.c:4295: print_message: Assertion `M' failed.
+        # tg-cli exits for other reasons too, so try again later
+        record_probe(msg, PROBE_FAILED, PROBE_EXITS)
+        return False
+    except Exception:
+        record_probe(msg, PROBE_FAILED)
+        raise
+    if res[0]:
+        status = None
+    elif (isinstance(answer, dict) and answer.get('result') == 'FAIL'
+          and PROBE_NOT_FOUND in answer.get('error', '')):
+        status = PROBE_MISSING
+    else:
+        # eg. FLOOD_WAIT, or a channel not known yet
+        status = PROBE_FAILED
+    record_probe(msg, status)
+    maybe_commit()
+    PROGRESS.add(res[1] or 0)
+    return bool(res[0])
 
 def export_holes():
     '''
@@ -412,66 +1533,87 @@ def export_holes():
     # First we get messages that belong to ourselves,
     # i.e. not channel messages or encr-chat
     # 17179869184 = TGL_PEER_ENCR_CHAT 4<<32
-    got = set(i[0] for i in CONN.execute('SELECT id FROM messages WHERE dest < 17179869184') if isinstance(i[0], int))
     # it doesn't verify peer_type, peer_id, access_hash
-    if got:
-        holes = [tgl_message_id_t(1, 0, n, 0) for n in find_holes(1, max(got), got)]
+    holes = [(1, 0, 0, start, end) for start, end in
+             hole_ranges('dest < 17179869184')]
     # Then we get channel (supergroup) messages.
     if TG_TEST:
         channels = [tgl_peer_id_t(tgl_peer_id_t.TGL_PEER_CHANNEL, *i) for i in
                     CONN.execute('SELECT id, access_hash FROM channels')]
         for channel in channels:
-            got = set(i[0] for i in CONN.execute('SELECT id FROM messages WHERE dest = ?', (channel.to_id(),)) if isinstance(i[0], int))
-            if got:
-                holes.extend(tgl_message_id_t(channel.peer_type, channel.peer_id, n, channel.access_hash) for n in find_holes(1, max(got), got))
-    length = len(holes)
-    logging.info('Getting the remaining %d messages...' % length)
+            holes.extend((channel.peer_type, channel.peer_id, channel.access_hash, start, end) for start, end in hole_ranges('dest = ?', (channel.to_id(),)))
+    holes, skipped = skip_probed(holes)
+    length = sum(end - start + 1 for *_, start, end in holes)
+    logging.info('Getting the remaining %d messages in %d ranges (%d skipped as probed before)...' % (length, len(holes), skipped))
     # we need some uncertainty to work around the uncertainty of telegram-cli
     random.shuffle(holes)
-    # list of mids (may be str or int, depending on TG_TEST)
+    PROGRESS.set_phase('holes', length)
     failed = []
-    for k, msg in enumerate(holes, 1):
-        if TG_TEST:
-            mid = msg.dumps()
-        else:
-            mid = msg.id
+    k = 0
+    for k, msg in enumerate(expand_holes(holes), 1):
         try:
-            res = process(TGCLI.send_command('get_message %s' % mid))
-            if not res[0]:
+            if not probe_hole(msg):
                 logging.warning('%r may not exist [%.2f%%]', msg[:3], (k * 100 / length))
             elif k % 10 == 0:
                 logging_status(k, False, 100, length)
-        except tgcli.TelegramCliExited:
-            # interface.c:4295: print_message: Assertion `M' failed.
-            logging.warning('%r may not exist [%.2f%%]', msg[:3], (k * 100 / length))
         except Exception:
-            failed.append(mid)
-            logging.exception('Failed to get message ID %s' % mid)
+            failed.append(msg)
+            logging.exception('Failed to get message ID %s' % msg.id)
+        PROGRESS.hole()
     logging_status(k, True, 100, length)
     purge_queue()
     while failed:
         length = len(failed)
         logging.info('Retrying the remaining %d messages...' % length)
+        PROGRESS.hole_retry(length)
         newlist = []
         # see above
         random.shuffle(failed)
-        for k, mid in enumerate(failed, 1):
+        for k, msg in enumerate(failed, 1):
             try:
-                res = process(TGCLI.send_command('get_message %s' % mid))
+                # see above, it may not exist
+                probe_hole(msg)
             except Exception:
                 # such an old bug (`newlist` here was `failed`)
-                newlist.append(mid)
+                newlist.append(msg)
             if k % 10 == 0:
                 logging_status(k, False, 100, length)
         logging_status(k, True, 100, length)
         failed = newlist
         purge_queue()
 
-def export_text(peer=None, force=False):
-    #if force:
-        #reset_finished()
+def export_dialogs(items, force=False):
+    '''
+    Export messages for a list of (item, pos), return the failed ones.
+    With more than one job, the dialogs are exported in parallel.
+    '''
+    def export_one(args):
+        item, pos = args
+        res = export_for(item, pos, force)
+        PROGRESS.peer_done(item, res)
+        if res is not None:
+            logging.warning('Failed to get messages for %s from %d' % (item['print_name'], res))
+        with DB_LOCK:
+            purge_queue()
+        return res
+
+    PROGRESS.set_phase('dialogs', len(items))
+    if JOBS > 1:
+        with concurrent.futures.ThreadPoolExecutor(JOBS) as executor:
+            results = list(executor.map(export_one, items))
+    else:
+        results = map(export_one, items)
+    return [(item, res) for (item, pos), res in zip(items, results) if res is not None]
+
+def get_dialogs(peer=None, cache=True):
+    '''
+    Get the contacts and dialogs, return the list of dialogs (newest first)
+    and the one matching `peer`. Without `cache`, dialog_list is not
+    answered from the response cache.
+    '''
+    global SELF_ID
     logging.info('Getting contacts...')
-    update_peer(TGCLI.cmd_get_self())
+    SELF_ID = tgl_peer_id_t.from_peer(update_peer(TGCLI.cmd_get_self())).to_id()
     items = TGCLI.cmd_contact_list()
     peer_obj = None
     if peer:
@@ -480,10 +1622,10 @@ def export_text(peer=None, force=False):
         update_peer(item)
     purge_queue()
     logging.info('Getting dialogs...')
-    dlist = items = lastitems = TGCLI.cmd_dialog_list(100)
+    dlist = items = lastitems = TGCLI.cmd_dialog_list(100, cache=cache)
     dcount = 100
     while items:
-        items = TGCLI.cmd_dialog_list(100, dcount)
+        items = TGCLI.cmd_dialog_list(100, dcount, cache=cache)
         if frozenset(d['id'] for d in items) == frozenset(d['id'] for d in lastitems):
             break
         dlist.extend(items)
@@ -497,52 +1639,233 @@ def export_text(peer=None, force=False):
             elif ((item.get('peer_type') or item.get('type')) == peer_match.group(1)
                 and str(item.get('peer_id') or item.get('id')) == peer_match.group(2)):
                 peer_obj = item
+    return uniq(dlist, key=lambda item: item['id']), peer_obj
+
+def export_text(peer=None, force=False):
+    #if force:
+        #reset_finished()
+    # the ranks are compared with the ones of last time, see schedule_dialogs
+    dlist, peer_obj = get_dialogs(peer, cache=False)
+    ranks = {item['id']: k for k, item in enumerate(dlist)}
     if peer_obj:
         logging.info('Peer: %r' % peer_obj)
         dlist = [peer_obj]
+        # the other dialogs are not exported, so it has to be compared
+        # with them again next time
+        ranks = {}
     elif peer:
         logging.info('Peer not found: %s' % peer)
         return
+    elif not force:
+        items = dlist
+        dlist = schedule_dialogs(items)
+        logging.info('%d of %d dialogs may have new messages.' % (len(dlist), len(items)))
+        # the ones skipped didn't change
+        changed = frozenset(item['id'] for item in dlist)
+        set_ranks([item for item in items if item['id'] not in changed], ranks)
+        # until exported, the changed ones are always exported again
+        set_ranks(dlist, {})
+    if force or peer_obj:
+        # we need some uncertainty to work around the uncertainty of telegram-cli
+        random.shuffle(dlist)
     logging.info('Exporting messages...')
-    failed = []
-    # we need some uncertainty to work around the uncertainty of telegram-cli
-    random.shuffle(dlist)
-    for item in dlist:
-        res = export_for(item, 0, force)
-        if res is not None:
-            failed.append((item, res))
-            logging.warning('Failed to get messages for %s from %d' % (item['print_name'], res))
-        purge_queue()
-    DB.commit()
+    failed = export_dialogs([(item, 0) for item in dlist], force)
+    failed_ids = frozenset(item['id'] for item, pos in failed)
+    set_ranks([item for item in dlist if item['id'] not in failed_ids], ranks)
+    commit()
     while failed:
-        newlist = []
-        for item, pos in failed:
-            res = export_for(item, pos, force)
-            if res is not None:
-                newlist.append((item, res))
-                logging.warning('Failed to get messages for %s from %d' % (item['print_name'], res))
-            purge_queue()
-        failed = newlist
-        DB.commit()
+        exported = failed
+        failed = export_dialogs(failed, force)
+        failed_ids = frozenset(item['id'] for item, pos in failed)
+        set_ranks([item for item, pos in exported if item['id'] not in failed_ids], ranks)
+        commit()
     logging.info('Export to database completed.')
 
+def peer_where(item):
+    '''
+    Return the SQL condition and parameters of the messages in the dialog
+    with `item`.
+    '''
+    pid = tgl_peer_id_t.from_peer(item).to_id()
+    if pid >> 32 == tgl_peer_id_t.TGL_PEER_USER:
+        return '(dest = ? OR (src = ? AND dest = ?))', (pid, pid, SELF_ID)
+    return 'dest = ?', (pid,)
+
+def digest_rows(rows):
+    '''
+    Digest of the message rows (as in `msg_row`), regardless of their order
+    and of the unread flag.
+    '''
+    h = hashlib.sha1()
+    for row in sorted(rows, key=lambda row: row[0]):
+        row = row[:10] + row[11:]
+        h.update(repr(tuple(int(v) if isinstance(v, bool) else v for v in row)).encode('utf-8'))
+    return h.hexdigest()
+
+def resync_windows(item, size=100):
+    '''
+    Yield (offset, start_id, end_id) of the stored messages of `item` in
+    windows of `size` messages, newest first.
+    '''
+    where, params = peer_where(item)
+    cur = DB.cursor()
+    ids = []
+    offset = 0
+    for row in cur.execute("SELECT id FROM messages WHERE %s AND typeof(id) = 'integer' ORDER BY id DESC" % where, params):
+        ids.append(row[0])
+        if len(ids) == size:
+            yield offset, ids[-1], ids[0]
+            offset += size
+            ids = []
+    if ids:
+        yield offset, ids[-1], ids[0]
+
+def resync_page(item, msglist):
+    '''
+    Compare the history page `msglist` with the stored messages in its id
+    range, and rewrite them if they differ. Return the id range, the digest
+    of the page and whether it was rewritten.
+
+    The stored messages out of the range are not touched: tg-cli may
+    return short pages in the middle of the history, so a page can't be
+    known to be the oldest one.
+    '''
+    msglist = [msg for msg in msglist if 'id' in msg]
+    rows = [msg_row(msg) for msg in msglist]
+    start = min(row[0] for row in rows)
+    end = max(row[0] for row in rows)
+    digest = digest_rows(rows)
+    where, params = peer_where(item)
+    stored = CONN.execute('SELECT * FROM messages WHERE %s AND id BETWEEN ? AND ?' % where, params + (start, end)).fetchall()
+    if digest_rows(stored) == digest:
+        PAYLOADS.pending.clear()
+        return start, end, digest, False
+    # a page is a continuous part of the history, so the messages not in
+    # it are deleted
+    ids = frozenset(row[0] for row in rows)
+    deleted = [(row[0], row[2]) for row in stored if row[0] not in ids]
+    SEARCH.remove(CONN, deleted + [(row[0], row[2]) for row in rows])
+    CONN.executemany('DELETE FROM messages WHERE id = ? AND dest IS ?', deleted)
+    PAYLOADS.flush(CONN)
+    CONN.executemany(SQL_UPSERT_MSG, rows)
+    SEARCH.add(CONN, msglist)
+    COMMIT.add(len(rows))
+    return start, end, digest, True
+
+def resync_for(item, fraction=1):
+    '''
+    Check the least recently checked `fraction` of the windows of stored
+    messages of `item` against the history, and repair the ones that
+    differ. Return the numbers of windows checked and repaired.
+    '''
+    pid = tgl_peer_id_t.from_peer(item).to_id()
+    with DB_LOCK:
+        checked = CONN.execute('SELECT start_id, end_id, checked FROM resync WHERE peer = ? ORDER BY start_id', (pid,)).fetchall()
+        windows = list(resync_windows(item))
+    starts = [row[0] for row in checked]
+
+    def last_checked(window):
+        k = bisect.bisect_right(starts, window[2]) - 1
+        if k >= 0 and checked[k][1] >= window[1]:
+            return checked[k][2]
+        return 0
+
+    windows.sort(key=last_checked)
+    windows = windows[:int(math.ceil(len(windows) * fraction))]
+    repaired = 0
+    for offset, start, end in sorted(windows):
+        msglist = TGCLI.cmd_history(print_id(item), 100, offset)
+        if not isinstance(msglist, list) or not any('id' in msg for msg in msglist):
+            continue
+        with DB_LOCK:
+            update_msg_peers(msglist)
+            start, end, digest, changed = resync_page(item, msglist)
+            repaired += changed
+            CONN.execute('DELETE FROM resync WHERE peer = ? AND start_id <= ? AND end_id >= ?', (pid, end, start))
+            CONN.execute('INSERT INTO resync VALUES (?,?,?,?,?)', (pid, start, end, digest, int(time.time())))
+            maybe_commit()
+    return len(windows), repaired
+
+def export_resync(peer=None, fraction=1):
+    '''
+    Check the stored messages against the history and repair the edited
+    or deleted ones.
+    '''
+    dlist, peer_obj = get_dialogs(peer)
+    if peer_obj:
+        dlist = [peer_obj]
+    elif peer:
+        logging.info('Peer not found: %s' % peer)
+        return
+    logging.info('Checking %.0f%% of stored messages...' % (fraction * 100))
+    for item in dlist:
+        try:
+            checked, repaired = resync_for(item, fraction)
+        except Exception:
+            logging.exception('Failed to check messages for %s' % item['print_name'])
+            continue
+        if checked:
+            logging.info('%s: %d windows checked, %d repaired' % (item['print_name'], checked, repaired))
+    with DB_LOCK:
+        pruned = PAYLOADS.prune(CONN)
+    if pruned:
+        logging.info('%d unused payloads deleted.' % pruned)
+    commit()
+    logging.info('Resync completed.')
+
 DB = None
 CONN = None
-PEER_CACHE = LRUCache(10)
-MSG_Q = queue.Queue()
+DB_LOCK = threading.RLock()
+PEER_CACHE = PeerCache()
+CODEC = JsonCodec()
+PAYLOADS = PayloadStore()
+SEARCH = SearchIndex()
+COMMIT = CommitPolicy()
+PROGRESS = Progress()
+MSG_Q = EventQueue()
 TGCLI = None
+PIPELINE = 1
+JOBS = 1
 DLDIR = '.'
 TG_TEST = True
+SELF_ID = None
+REPROBE = False
+# seconds to wait before probing a failed message id again, doubled after
+# each failure
+PROBE_BACKOFF = 3600
+PROBE_BACKOFF_MAX = 30 * 86400
+# a message is taken as missing after tg-cli exits on it this many times
+PROBE_EXITS = 3
 
 def main(argv):
-    global TGCLI, DLDIR, TG_TEST
+    global TGCLI, PIPELINE, JOBS, DLDIR, TG_TEST, REPROBE
     parser = argparse.ArgumentParser(description="Export Telegram messages.")
     parser.add_argument("-o", "--output", help="output path", default="export")
     parser.add_argument("-d", "--db", help="database path", default="tg-export3.db")
     parser.add_argument("-f", "--force", help="force download all messages", action='store_true')
     parser.add_argument("-p", "--peer", help="only download messages for this peer (format: channel#id1001234567, or use partial name/title as shown in tgcli)")
     parser.add_argument("-B", "--batch-only", help="fetch messages in batch only, don't try to get more missing messages", action='store_true')
-    parser.add_argument("-t", "--timeout", help="tg-cli command timeout", type=int, default=30)
+    parser.add_argument("-s", "--resync", help="instead of exporting, check this fraction (0-1) of the stored messages of each dialog, the least recently checked first, and repair the edited or deleted ones", type=float)
+    parser.add_argument("-r", "--reprobe", help="try again to get the missing messages known not to exist", action='store_true')
+    parser.add_argument("-t", "--timeout", help="tg-cli command timeout (the upper limit with -A)", type=int, default=30)
+    parser.add_argument("-A", "--adaptive-timeout", help="set timeouts of each kind of command from its recent latencies", action='store_true')
+    parser.add_argument("-P", "--pipeline", help="number of history pages to request at a time", type=int, default=1)
+    parser.add_argument("-j", "--jobs", help="number of telegram-cli processes to export with", type=int, default=1)
+    parser.add_argument("--profile", help="telegram-cli config directory, copied for each process when using -j (default ~/.telegram-cli)")
+    parser.add_argument("-S", "--standby", help="keep a standby telegram-cli process to replace a dead one at once", action='store_true')
+    parser.add_argument("-M", "--metrics", help="write tg-cli metrics in Prometheus text format to this file periodically")
+    parser.add_argument("--metrics-interval", help="seconds between writing metrics", type=int, default=30)
+    parser.add_argument("-c", "--cache", help="cache file for read-only tg-cli queries (default: next to the database)")
+    parser.add_argument("--no-cache", help="don't cache tg-cli queries", action='store_true')
+    parser.add_argument("-R", "--refresh", help="refresh cached tg-cli queries", action='store_true')
+    parser.add_argument("--commit-every", help="commit after this number of messages", type=int, default=1000)
+    parser.add_argument("--commit-interval", help="commit after this number of seconds", type=float, default=10)
+    parser.add_argument("--status", help="write the progress as JSON to this file periodically ('-' for stdout)")
+    parser.add_argument("--status-interval", help="seconds between writing the progress", type=int, default=10)
+    parser.add_argument("--queue-size", help="number of events waiting to be stored in logging mode, above 80%% of which the less important ones are dropped", type=int, default=10000)
+    parser.add_argument("--compact", help="store media and action compressed with a dictionary trained on this database (can't be undone)", action='store_true')
+    parser.add_argument("--dedup", help="store large text and media values once, referred to by their hash (can't be undone, use --compact before or with it)", action='store_true')
+    parser.add_argument("--fts", help="build a full-text index of the messages for `logfmt.py -S`, and keep it up to date", action='store_true')
     parser.add_argument("-l", "--logging", help="logging mode (keep running)", action='store_true')
     parser.add_argument("-L", "--keep-logging", help="first export, then keep logging", action='store_true')
     parser.add_argument("-e", "--tgbin", help="telegram-cli binary path", default="bin/telegram-cli")
@@ -554,34 +1877,81 @@ def main(argv):
         tgcli.logger.setLevel(logging.DEBUG)
 
     DLDIR = args.output
+    PIPELINE = max(1, args.pipeline)
+    JOBS = max(1, args.jobs)
+    REPROBE = args.reprobe
+    MSG_Q.maxsize = args.queue_size
+    MSG_Q.high_water = int(args.queue_size * 0.8)
+    COMMIT.max_msgs = args.commit_every
+    # also the longest wait of the writer thread in logging mode
+    COMMIT.interval = max(0.1, args.commit_interval)
     init_db(args.db)
+    if args.compact and CODEC.dict_id is None:
+        logging.info('Compacting the database...')
+        logging.info('%d messages recoded.' % CODEC.enable(CONN))
+        commit()
+    if args.dedup and not PAYLOADS.enabled:
+        logging.info('Deduplicating the database...')
+        logging.info('%d messages changed.' % PAYLOADS.enable(CONN))
+        commit()
+    if args.fts and not SEARCH.enabled:
+        logging.info('Building the full-text index...')
+        logging.info('%d messages indexed.' % SEARCH.enable(CONN))
+        commit()
+    cache = None
+    if not args.no_cache:
+        cache = tgcli.ResponseCache(args.cache or os.path.splitext(args.db)[0] + '.cache.db', refresh=args.refresh)
 
-    TGCLI = tgcli.TelegramCliInterface(args.tgbin, extra_args=('-W', '-E'), run=False, timeout=args.timeout)
-    TGCLI.on_json = MSG_Q.put
+    if JOBS > 1:
+        TGCLI = tgcli.TelegramCliPool(args.tgbin, JOBS, extra_args=('-W', '-E'), run=False, timeout=args.timeout, profile=args.profile, standby=args.standby, adaptive_timeout=args.adaptive_timeout, cache=cache)
+    else:
+        TGCLI = tgcli.TelegramCliInterface(args.tgbin, extra_args=('-W', '-E'), run=False, timeout=args.timeout, standby=args.standby, adaptive_timeout=args.adaptive_timeout, cache=cache)
+    TGCLI.on_json_batch = MSG_Q.put
     TGCLI.on_info = lambda s: tgcli.logger.info(s) if not re_getmsg.match(s) else None
     #TGCLI.on_text = MSG_Q.put
     #TGCLI.on_start = on_start
+    if args.metrics:
+        TGCLI.stats.start_dump(args.metrics, args.metrics_interval)
+    if args.status:
+        PROGRESS.start_dump(args.status, args.status_interval)
     TGCLI.run()
     TGCLI.ready.wait()
-    time.sleep(1)
 
     # the 'test' branch of tg has channel support
     TG_TEST = 'channel' in TGCLI.cmd_help()
 
     try:
-        if not args.logging:
+        if args.resync:
+            export_resync(args.peer, args.resync)
+        elif not args.logging:
             export_text(args.peer, args.force)
             if not args.batch_only:
                 export_holes()
         if args.logging or args.keep_logging:
-            while TGCLI.ready.is_set():
-                d = MSG_Q.get()
-                logging.info(logging_fmt(d))
-                process(d)
+            PROGRESS.set_phase('logging')
+            stop = threading.Event()
+            writer = threading.Thread(target=write_events, args=(stop,))
+            MSG_Q.set_block(True)
+            writer.start()
+            try:
+                # tg-cli is restarted by itself when it dies
+                while not TGCLI.closed and writer.is_alive():
+                    writer.join(1)
+            finally:
+                MSG_Q.set_block(False)
+                stop.set()
+                writer.join()
     finally:
         TGCLI.close()
         purge_queue()
-        DB.commit()
+        commit()
+        if cache:
+            logging.info('Cached tg-cli queries: %d hits, %d misses' % (cache.hits, cache.misses))
+            cache.close()
+        if args.metrics:
+            TGCLI.stats.dump(args.metrics)
+        if args.status:
+            PROGRESS.dump(args.status)
 
 if __name__ == '__main__':
     sys.exit(main(sys.argv[1:]))
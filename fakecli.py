@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+A fake telegram-cli for offline testing and benchmarking.
+
+It speaks the `-S` socket interface (`ANSWER <size>` frames) and prints
+`--json` events on stdout, serving synthetic dialogs, channels and
+histories. The known failure modes of tg-cli can be injected on demand.
+
+All settings are read from environment variables, so that it can be used
+in place of the real binary without changing the command line:
+
+    TGFAKE_SEED         random seed (default 1)
+    TGFAKE_USERS        number of user dialogs (default 20)
+    TGFAKE_CHATS        number of chats (default 5)
+    TGFAKE_CHANNELS     number of channels (default 5)
+    TGFAKE_MESSAGES     messages per dialog (default 500)
+    TGFAKE_MEMBERS      members per chat or channel (default 50)
+    TGFAKE_DELETED      fraction of deleted message ids (default 0.01)
+    TGFAKE_LATENCY      seconds added to each command (default 0)
+    TGFAKE_STARTUP      seconds before the socket is created (default 0)
+    TGFAKE_EVENTS       new messages per second pushed on stdout (default 0)
+    TGFAKE_EXIT         probability of exiting on a command (default 0)
+    TGFAKE_STALL        probability of not answering a command (default 0)
+    TGFAKE_HALF         probability of a half answer, with the rest
+                        following after TGFAKE_STALL_TIME (default 0)
+    TGFAKE_EMPTY        probability of an empty `history` page (default 0)
+    TGFAKE_STALL_TIME   seconds to stall (default 5)
+    TGFAKE_CRASH_MISSING
+                        exit when `get_message` hits a deleted message,
+                        like the upstream tg-cli does (default 1)
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import struct
+import binascii
+import threading
+
+TGL_PEER_USER = 1
+TGL_PEER_CHAT = 2
+TGL_PEER_CHANNEL = 5
+
+PEER_TYPES = {TGL_PEER_USER: 'user', TGL_PEER_CHAT: 'chat', TGL_PEER_CHANNEL: 'channel'}
+
+def getenv(name, default, type=float):
+    return type(os.environ.get('TGFAKE_' + name, default))
+
+class FakeTelegram:
+
+    def __init__(self):
+        self.rnd = random.Random(getenv('SEED', 1, int))
+        self.lock = threading.RLock()
+        self.latency = getenv('LATENCY', 0)
+        self.p_exit = getenv('EXIT', 0)
+        self.p_stall = getenv('STALL', 0)
+        self.p_half = getenv('HALF', 0)
+        self.p_empty = getenv('EMPTY', 0)
+        self.stall_time = getenv('STALL_TIME', 5)
+        self.crash_missing = getenv('CRASH_MISSING', 1, int)
+        self.peers = {}
+        # peer key -> list of message dicts, newest first
+        self.history = {}
+        # (peer_type, peer_id, id) -> message
+        self.index = {}
+        self.deleted = set()
+        self.global_id = 0
+        self.self_peer = self.make_peer(TGL_PEER_USER, 100000, 'Me')
+        self.users = [self.make_peer(TGL_PEER_USER, 200000 + n, 'User %d' % n)
+                      for n in range(getenv('USERS', 20, int))]
+        self.chats = [self.make_peer(TGL_PEER_CHAT, 300000 + n, 'Chat %d' % n)
+                      for n in range(getenv('CHATS', 5, int))]
+        self.channels = [self.make_peer(TGL_PEER_CHANNEL, 1000000000 + n, 'Channel %d' % n)
+                         for n in range(getenv('CHANNELS', 5, int))]
+        nmembers = getenv('MEMBERS', 50, int)
+        self.members = {}
+        for peer in self.chats + self.channels:
+            self.members[peer['id']] = [
+                self.make_peer(TGL_PEER_USER, 400000 + self.rnd.randrange(nmembers * 10), None)
+                for n in range(nmembers)]
+        self.generate(getenv('MESSAGES', 500, int), getenv('DELETED', 0.01))
+
+    def make_peer(self, peer_type, peer_id, name):
+        access_hash = peer_id * 7919 if peer_type != TGL_PEER_CHAT else 0
+        name = name or 'Member %d' % peer_id
+        peer = {
+            'id': '$' + binascii.b2a_hex(struct.pack('<iiq', peer_type, peer_id, access_hash)).decode('ascii'),
+            'peer_type': PEER_TYPES[peer_type],
+            'peer_id': peer_id,
+            'print_name': name.replace(' ', '_'),
+            'flags': 1
+        }
+        if peer_type == TGL_PEER_USER:
+            peer['first_name'], _, peer['last_name'] = name.partition(' ')
+            peer['username'] = name.replace(' ', '').lower()
+            peer['phone'] = str(8600000000000 + peer_id)
+            peer['photo_id'] = str(peer_id * 31)
+        elif peer_type == TGL_PEER_CHAT:
+            peer['title'] = name
+            peer['members_num'] = 0
+        else:
+            peer['title'] = name
+            peer['participants_count'] = 0
+            peer['admins_count'] = 1
+            peer['kicked_count'] = 0
+        self.peers[self.peer_key(peer)] = peer
+        self.peers.setdefault(peer['print_name'], peer)
+        return peer
+
+    @staticmethod
+    def peer_key(peer):
+        return '%s#id%d' % (peer['peer_type'], peer['peer_id'])
+
+    def find_peer(self, name):
+        if name.startswith('$'):
+            peer_type, peer_id, access_hash = struct.unpack('<iiq', binascii.a2b_hex(name[1:]))
+            name = '%s#id%d' % (PEER_TYPES[peer_type], peer_id)
+        return self.peers.get(name)
+
+    def msgid(self, peer, mid):
+        peer_type = {'user': TGL_PEER_USER, 'chat': TGL_PEER_CHAT, 'channel': TGL_PEER_CHANNEL}[peer['peer_type']]
+        access_hash = struct.unpack('<iiq', binascii.a2b_hex(peer['id'][1:]))[2]
+        return binascii.b2a_hex(struct.pack('<IIqq', peer_type, peer['peer_id'], mid, access_hash)).decode('ascii')
+
+    def new_message(self, dialog, date, deleted_rate=0):
+        with self.lock:
+            hist = self.history.setdefault(self.peer_key(dialog), [])
+            if dialog['peer_type'] == 'channel':
+                mid = (int(hist[0]['_id']) if hist else 0) + 1
+                home = dialog
+                sender = dialog
+                to = dialog
+                key = (TGL_PEER_CHANNEL, dialog['peer_id'], mid)
+            else:
+                self.global_id += 1
+                mid = self.global_id
+                home = self.self_peer
+                key = (TGL_PEER_USER, 0, mid)
+                if dialog['peer_type'] == 'chat':
+                    sender = self.rnd.choice(self.members[dialog['id']] + [self.self_peer])
+                    to = dialog
+                elif self.rnd.random() < 0.5:
+                    sender, to = self.self_peer, dialog
+                else:
+                    sender, to = dialog, self.self_peer
+            if self.rnd.random() < deleted_rate:
+                self.deleted.add(key)
+                return None
+            msg = {
+                'event': 'message',
+                'id': self.msgid(home, mid),
+                '_id': mid,
+                'flags': 257,
+                'from': sender,
+                'to': to,
+                'out': sender is self.self_peer,
+                'unread': False,
+                'service': False,
+                'date': date,
+                'text': 'Message %d in %s: %s' % (mid, dialog['print_name'],
+                    ' '.join(self.rnd.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet')) for _ in range(self.rnd.randrange(1, 30))))
+            }
+            if self.rnd.random() < 0.1:
+                msg['media'] = {'type': 'photo', 'caption': ''}
+            hist.insert(0, msg)
+            self.index[key] = msg
+            return msg
+
+    def generate(self, count, deleted_rate):
+        dialogs = self.users + self.chats + self.channels
+        slots = [d for d in dialogs for _ in range(count)]
+        self.rnd.shuffle(slots)
+        date = int(time.time()) - len(slots) * 60
+        for dialog in slots:
+            date += 60
+            self.new_message(dialog, date, deleted_rate)
+
+    @staticmethod
+    def public(msg):
+        return {k: v for k, v in msg.items() if k[0] != '_'}
+
+    def execute(self, line):
+        args = line.split()
+        if not args:
+            return None
+        name, args = args[0], args[1:]
+        func = getattr(self, 'cmd_' + name, None)
+        if func is None:
+            return {'result': 'FAIL', 'error_code': 710, 'error': 'can not parse command name'}
+        return func(*args)
+
+    def cmd_help(self, *args):
+        return 'help\nhistory <peer> [limit] [offset]\nchannel_get_members <channel> [limit] [offset]\nget_message <msg-id>\n'
+
+    def cmd_get_self(self):
+        return self.self_peer
+
+    def cmd_contact_list(self):
+        return self.users[:len(self.users) // 2]
+
+    def cmd_dialog_list(self, limit=100, offset=0):
+        with self.lock:
+            dialogs = sorted(self.users + self.chats + self.channels,
+                key=lambda d: -self.history.get(self.peer_key(d), [{'date': 0}])[0]['date'])
+        return dialogs[int(offset):int(offset) + int(limit)]
+
+    def cmd_history(self, peer, limit=100, offset=0):
+        dialog = self.find_peer(peer)
+        if dialog is None:
+            return {'result': 'FAIL', 'error_code': 710, 'error': 'can not parse arg #1'}
+        if self.rnd.random() < self.p_empty:
+            return []
+        with self.lock:
+            hist = self.history.get(self.peer_key(dialog), [])
+            page = hist[int(offset):int(offset) + int(limit)]
+        return [self.public(m) for m in reversed(page)]
+
+    def cmd_get_message(self, mid):
+        if mid.isdigit():
+            key = (TGL_PEER_USER, 0, int(mid))
+        else:
+            peer_type, peer_id, mid, access_hash = struct.unpack('<IIqq', binascii.a2b_hex(mid))
+            if peer_type != TGL_PEER_CHANNEL:
+                peer_type, peer_id = TGL_PEER_USER, 0
+            key = (peer_type, peer_id, mid)
+        msg = self.index.get(key)
+        if msg is None:
+            if self.crash_missing:
+                print('interface.c:4295: print_message: Assertion `M\' failed.', flush=True)
+                os._exit(134)
+            return {'result': 'FAIL', 'error_code': 0, 'error': 'no such message'}
+        return self.public(msg)
+
+    def cmd_channel_get_members(self, peer, limit=100, offset=0):
+        dialog = self.find_peer(peer)
+        if dialog is None or dialog['peer_type'] != 'channel':
+            return {'result': 'FAIL', 'error_code': 710, 'error': 'can not parse arg #1'}
+        return self.members[dialog['id']][int(offset):int(offset) + int(limit)]
+
+    def cmd_chat_info(self, peer):
+        dialog = self.find_peer(peer)
+        if dialog is None or dialog['peer_type'] != 'chat':
+            return {'result': 'FAIL', 'error_code': 710, 'error': 'can not parse arg #1'}
+        info = dict(dialog)
+        info['members'] = self.members[dialog['id']]
+        return info
+
+    def _load_photo(self, peer):
+        dialog = self.find_peer(peer)
+        if dialog is None:
+            return {'result': 'FAIL', 'error_code': 710, 'error': 'can not parse arg #1'}
+        filename = os.path.join(DOWNLOADS, 'photo_%s_%d.jpg' % (dialog['peer_type'], dialog['peer_id']))
+        with open(filename, 'wb') as f:
+            f.write(b'\xff\xd8\xff\xe0' + ('%s' % dialog.get('photo_id', dialog['peer_id'])).encode('ascii') * 64)
+        return {'result': filename}
+
+    cmd_load_user_photo = cmd_load_chat_photo = cmd_load_channel_photo = _load_photo
+
+def send_answer(conn, fake, reply):
+    if isinstance(reply, str):
+        data = reply.encode('utf-8')
+    else:
+        data = json.dumps(reply).encode('utf-8') + b'\n'
+    frame = b'ANSWER %d\n' % len(data) + data
+    if fake.rnd.random() < fake.p_half:
+        half = len(frame) // 2
+        conn.sendall(frame[:half])
+        time.sleep(fake.stall_time)
+        conn.sendall(frame[half:])
+    else:
+        conn.sendall(frame)
+
+def serve_conn(conn, fake):
+    rfile = conn.makefile('rb')
+    try:
+        for line in rfile:
+            line = line.decode('utf-8').strip()
+            if fake.latency:
+                time.sleep(fake.latency)
+            roll = fake.rnd.random()
+            if roll < fake.p_exit:
+                print('*** lost connection, exiting', flush=True)
+                os._exit(1)
+            elif roll < fake.p_exit + fake.p_stall:
+                time.sleep(fake.stall_time)
+                continue
+            reply = fake.execute(line)
+            if reply is not None:
+                send_answer(conn, fake, reply)
+    except (BrokenPipeError, ConnectionResetError):
+        pass
+    finally:
+        conn.close()
+
+def push_events(fake, rate):
+    dialogs = fake.users + fake.chats + fake.channels
+    while True:
+        time.sleep(1 / rate)
+        msg = fake.new_message(fake.rnd.choice(dialogs), int(time.time()))
+        if msg:
+            line = json.dumps(fake.public(msg))
+            with STDOUT_LOCK:
+                sys.stdout.write(line + '\n')
+                sys.stdout.flush()
+
+def main(argv):
+    global DOWNLOADS
+    sockfile = None
+    if '-S' in argv:
+        sockfile = argv[argv.index('-S') + 1]
+    DOWNLOADS = os.path.join(os.path.dirname(sockfile or '.'), 'downloads')
+    os.makedirs(DOWNLOADS, exist_ok=True)
+    fake = FakeTelegram()
+    time.sleep(getenv('STARTUP', 0))
+    print('Telegram-cli version 1.4.1 (fake), Copyright (C) 2013-2015 Vitaly Valtman', flush=True)
+    if sockfile:
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(sockfile)
+        server.listen(16)
+    rate = getenv('EVENTS', 0)
+    if rate:
+        thread = threading.Thread(target=push_events, args=(fake, rate))
+        thread.daemon = True
+        thread.start()
+    if not sockfile:
+        for line in sys.stdin:
+            print(json.dumps(fake.execute(line)), flush=True)
+        return
+    while True:
+        conn, addr = server.accept()
+        thread = threading.Thread(target=serve_conn, args=(conn, fake))
+        thread.daemon = True
+        thread.start()
+
+DOWNLOADS = '.'
+STDOUT_LOCK = threading.Lock()
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
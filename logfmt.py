@@ -6,6 +6,7 @@ import re
 import sys
 import time
 import json
+import zlib
 import struct
 import sqlite3
 import operator
@@ -15,6 +16,8 @@ import collections
 
 import jinja2
 
+import dbschema
+
 re_url = re.compile(r'''\b
 (
     # URL (gruber v2)
@@ -45,6 +48,17 @@ re_url = re.compile(r'''\b
 )''', re.I | re.X)
 re_bthash = re.compile(r'[0-9a-f]{40}|[a-z2-7]{32}', re.I)
 re_limit = re.compile(r'^([0-9]+)(,[0-9]+)?$')
+
+MSG_COLUMNS = 'id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags'
+
+# the messages of a peer in time order, merged from the sent and received
+# ones, each read in order from idx_messages_dest and idx_messages_src
+SQL_PEER_MSGS = ('SELECT %(cols)s FROM %(table)s WHERE dest = ? UNION ALL '
+    'SELECT %(cols)s FROM %(table)s WHERE src = ? AND dest IS NOT ? '
+    'ORDER BY date %(order)s, id %(order)s %(limit)s')
+
+# the messages before or after one (date, id) in a dialog
+SQL_CONTEXT_PART = 'SELECT %(cols)s FROM %(table)s WHERE %(where)s AND (date, id) %(op)s (?, ?)'
 imgfmt = frozenset(('.jpg', '.jpeg', '.png', '.gif', '.webp', '.bmp'))
 
 printname = lambda first, last='': (first + ' ' + last if last else first) or '<Unknown>'
@@ -78,6 +92,15 @@ unkmsg = lambda mid: {
     'flags': 0
 }
 
+def decode_json(value, dicts):
+    '''
+    Decode a media or action value compressed by `export.JsonCodec`.
+    '''
+    if not isinstance(value, bytes):
+        return value
+    d = zlib.decompressobj(-15, zdict=dicts[struct.unpack('<H', value[1:3])[0]])
+    return (d.decompress(value[3:]) + d.flush()).decode('utf-8')
+
 def convert_msgid2(msgid):
     if msgid is None:
         return None
@@ -272,6 +295,9 @@ class Messages:
         self.db_cli = None
         self.conn_cli = None
         self.db_cli_ver = None
+        self.blob_dicts = {}
+        # v_messages_raw if the text and media are deduplicated
+        self.msg_table = 'messages'
         self.db_bot = None
         self.conn_bot = None
 
@@ -306,6 +332,18 @@ class Messages:
                         else:
                             self.db_cli_ver = 3
                         break
+                if self.db_cli_ver == 3:
+                    try:
+                        dbschema.migrate(self.db_cli)
+                    except sqlite3.OperationalError:
+                        # read-only, the queries work without the indexes
+                        pass
+                    try:
+                        self.blob_dicts = dict(self.conn_cli.execute('SELECT id, data FROM blob_dicts'))
+                    except sqlite3.OperationalError:
+                        pass
+                    if self.conn_cli.execute("SELECT 1 FROM sqlite_master WHERE type='view' AND name='v_messages_raw'").fetchone():
+                        self.msg_table = 'v_messages_raw'
                 self.userfromdb('cli')
             elif dbtype == 'bot':
                 self.db_bot = sqlite3.connect(filename)
@@ -322,18 +360,31 @@ class Messages:
         else:
             raise FileNotFoundError('Database not found: ' + filename)
 
-    def msgfromdb(self, dbtype='cli', peer=None):
+    def limitsql(self):
         if self.limit:
             match = re_limit.match(self.limit)
             if match:
                 if match.group(2):
-                    limit = 'LIMIT %d OFFSET %s' % (min(int(match.group(1)), self.hardlimit), match.group(2)[1:])
+                    return 'LIMIT %d OFFSET %s' % (min(int(match.group(1)), self.hardlimit), match.group(2)[1:])
                 else:
-                    limit = 'LIMIT %d' % min(int(match.group(1)), self.hardlimit)
+                    return 'LIMIT %d' % min(int(match.group(1)), self.hardlimit)
             else:
-                limit = 'LIMIT %d' % self.hardlimit
+                return 'LIMIT %d' % self.hardlimit
         else:
-            limit = ''
+            return ''
+
+    def convert_clirow(self, row):
+        mid, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags = row
+        if self.blob_dicts:
+            media = decode_json(media, self.blob_dicts)
+            action = decode_json(action, self.blob_dicts)
+        if self.media_format == 'bot':
+            media, caption = self.media_cli2bot(media, action)
+            text = text or caption
+        return convert_msgid2(mid), src, dest, text, media, date, fwd_src, fwd_date, convert_msgid2(reply_id), out, unread, service, action, flags
+
+    def msgfromdb(self, dbtype='cli', peer=None):
+        limit = self.limitsql()
         if dbtype == 'cli':
             if peer:
                 if self.db_cli_ver == 1:
@@ -345,14 +396,18 @@ class Messages:
                     pid = tgl_peer_id_t.from_peer(peer).dumps()
                 else:
                     pid = tgl_peer_id_t.from_peer(peer).to_id()
-                c = self.conn_cli.execute('SELECT * FROM (SELECT id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags FROM messages WHERE src=? or dest=? ORDER BY date DESC, id DESC %s) ORDER BY date ASC, id ASC' % limit, (pid, pid))
+                sql = {'cols': MSG_COLUMNS, 'table': self.msg_table}
+                if limit:
+                    # the last ones
+                    sql.update(order='DESC', limit=limit)
+                    c = reversed(self.conn_cli.execute(SQL_PEER_MSGS % sql, (pid, pid, pid)).fetchall())
+                else:
+                    sql.update(order='ASC', limit='')
+                    c = self.conn_cli.execute(SQL_PEER_MSGS % sql, (pid, pid, pid))
             else:
-                c = self.conn_cli.execute('SELECT * FROM (SELECT id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags FROM messages ORDER BY date DESC, id DESC %s) ORDER BY date ASC, id ASC' % limit)
-            for mid, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags in c:
-                if self.media_format == 'bot':
-                    media, caption = self.media_cli2bot(media, action)
-                    text = text or caption
-                yield convert_msgid2(mid), src, dest, text, media, date, fwd_src, fwd_date, convert_msgid2(reply_id), out, unread, service, action, flags
+                c = self.conn_cli.execute('SELECT * FROM (SELECT id, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags FROM %s ORDER BY date DESC, id DESC %s) ORDER BY date ASC, id ASC' % (self.msg_table, limit))
+            for row in c:
+                yield self.convert_clirow(row)
         elif dbtype == 'bot' and self.botdest:
             for mid, src, text, media, date, fwd_src, fwd_date, reply_id in self.conn_bot.execute('SELECT * FROM (SELECT id, src, text, media, date, fwd_src, fwd_date, reply_id FROM messages ORDER BY date DESC, id DESC %s) ORDER BY date ASC, id ASC' % limit):
                 if self.media_format == 'cli':
@@ -563,9 +618,43 @@ class Messages:
             # ignore other undefined types to Bot API
         return json.dumps(d) if d else None, caption
 
+    def makemsg(self, db, mid, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags):
+        if fwd_src:
+            msgtype = 'fwd'
+            extra = {'fwd_src': self.peers[fwd_src], 'fwd_date': fwd_date}
+        elif reply_id:
+            msgtype = 're'
+            remsg = self.msgs.get(reply_id, unkmsg(reply_id))
+            if remsg['msgtype'] == 're':
+                remsg = remsg.copy()
+                remsg['extra'] = None
+            extra = {'reply': remsg}
+        else:
+            msgtype, extra = '', None
+        media = json.loads(media or '{}')
+        if db == 'bot' and '_ircuser' in media:
+            src['first_name'] = src['print'] = media['_ircuser']
+        msg = {
+            'mid': mid,
+            'src': src,
+            'dest': dest,
+            'text': text or media.get('caption'),
+            'media': media,
+            'date': date,
+            'msgtype': msgtype,
+            'extra': extra,
+            'out': out,
+            'unread': unread,
+            'service': service,
+            'action': json.loads(action or '{}'),
+            'flags': flags
+        }
+        self.msgs[mid] = msg
+        return msg
+
     def getmsgs(self, peer=None):
         db = 'cli' if self.db_cli else 'bot'
-        for mid, src, dest, text, media, date, fwd_src, fwd_date, reply_id, out, unread, service, action, flags in self.msgfromdb(db, peer):
+        for mid, src, dest, *row in self.msgfromdb(db, peer):
             src = self.peers[src]
             dest = self.peers[dest]
             if not (db == 'bot' or
@@ -573,40 +662,62 @@ class Messages:
                 peer['type'] == 'user' and
                 src['id'] == peer['id'] and dest['type'] == 'user'):
                 continue
-            if fwd_src:
-                msgtype = 'fwd'
-                extra = {'fwd_src': self.peers[fwd_src], 'fwd_date': fwd_date}
-            elif reply_id:
-                msgtype = 're'
-                remsg = self.msgs.get(reply_id, unkmsg(reply_id))
-                if remsg['msgtype'] == 're':
-                    remsg = remsg.copy()
-                    remsg['extra'] = None
-                extra = {'reply': remsg}
-            else:
-                msgtype, extra = '', None
-            media = json.loads(media or '{}')
-            if db == 'bot' and '_ircuser' in media:
-                src['first_name'] = src['print'] = media['_ircuser']
-            msg = {
-                'mid': mid,
-                'src': src,
-                'dest': dest,
-                'text': text or media.get('caption'),
-                'media': media,
-                'date': date,
-                'msgtype': msgtype,
-                'extra': extra,
-                'out': out,
-                'unread': unread,
-                'service': service,
-                'action': json.loads(action or '{}'),
-                'flags': flags
-            }
-            self.msgs[mid] = msg
+            yield mid, self.makemsg(db, mid, src, dest, *row)
+
+    def searchmsgs(self, query, peer=None, context=2):
+        '''
+        Find the messages matching the FTS5 `query` in the full-text index
+        made by `export.py --fts`, with `context` messages before and after
+        each one in its dialog. The matching ones have `msg['hit']` set.
+        '''
+        if self.db_cli_ver != 3 or not self.conn_cli.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='messages_fts'").fetchone():
+            raise ValueError('no full-text index in the database, see export.py --fts')
+        sql = 'SELECT m.id, m.src, m.dest, m.date FROM messages_fts f JOIN messages m ON m.rowid = f.rowid WHERE messages_fts MATCH ?'
+        params = (query,)
+        if peer:
+            pid = tgl_peer_id_t.from_peer(peer).to_id()
+            sql += ' AND (m.src = ? OR m.dest = ?)'
+            params += (pid, pid)
+        # the best matches first, then in time order
+        hits = sorted(self.conn_cli.execute('%s ORDER BY f.rank %s' % (sql, self.limitsql()), params).fetchall(), key=operator.itemgetter(3, 0))
+        hitkeys = frozenset((dest, mid) for mid, src, dest, date in hits)
+        rows = collections.OrderedDict()
+        for mid, src, dest, date in hits:
+            before = self.conn_cli.execute(*self.context_sql(src, dest, date, mid, '<', context)).fetchall()
+            after = self.conn_cli.execute(*self.context_sql(src, dest, date, mid, '>=', context + 1)).fetchall()
+            for row in reversed(before):
+                rows[row[2], row[0]] = row
+            for row in after:
+                rows[row[2], row[0]] = row
+        for key, row in rows.items():
+            mid, src, dest, *row = self.convert_clirow(row)
+            msg = self.makemsg('cli', mid, self.peers[src], self.peers[dest], *row)
+            msg['hit'] = key in hitkeys
             yield mid, msg
 
-    def render_peer(self, peer, name=None):
+    def context_sql(self, src, dest, date, mid, op, limit):
+        '''
+        Return the query and parameters of `limit` messages before (`op` is
+        '<') or after (`op` is '>=') the message (`date`, `mid`) in its
+        dialog, nearest first.
+        '''
+        if dest >> 32 == tgl_peer_id_t.TGL_PEER_USER:
+            # both directions of a private chat
+            parts = (('dest = ? AND src = ?', (dest, src)), ('dest = ? AND src = ?', (src, dest)))
+        else:
+            parts = (('dest = ?', (dest,)),)
+        order = 'DESC' if op == '<' else 'ASC'
+        sql = ' UNION ALL '.join(SQL_CONTEXT_PART % {'cols': MSG_COLUMNS, 'table': self.msg_table, 'where': where, 'op': op} for where, p in parts)
+        sql += ' ORDER BY date %s, id %s LIMIT ?' % (order, order)
+        params = sum((p + (date, mid) for where, p in parts), ()) + (limit,)
+        return sql, params
+
+    def render_peer(self, peer, name=None, msgs=None):
+        '''
+        Render the messages of `peer`, or the (mid, msg) pairs of `msgs`.
+        '''
+        if msgs is None:
+            msgs = self.getmsgs(peer)
         peer = peer.copy()
         if name:
             peer['print'] = name
@@ -615,9 +726,9 @@ class Messages:
             'gentime': time.time()
         }
         if self.stream:
-            kvars['msgs'] = (m for k, m in self.getmsgs(peer))
+            kvars['msgs'] = (m for k, m in msgs)
         else:
-            msgs = tuple(m for k, m in self.getmsgs(peer))
+            msgs = tuple(m for k, m in msgs)
             kvars['msgs'] = msgs
             if msgs:
                 kvars['start'] = min(msgs, key=operator.itemgetter('date'))['date']
@@ -628,7 +739,9 @@ class Messages:
         template = self.jinjaenv.get_template(self.template)
         yield from template.stream(**kvars)
 
-    def render_peer_json(self, peer, name=None):
+    def render_peer_json(self, peer, name=None, msgs=None):
+        if msgs is None:
+            msgs = self.getmsgs(peer)
         je = json.JSONEncoder(indent=0)
         peer = peer.copy()
         if name:
@@ -637,7 +750,7 @@ class Messages:
             'peer': peer,
             'gentime': time.time()
         }
-        kvars['msgs'] = StreamArray(m for k, m in self.getmsgs(peer))
+        kvars['msgs'] = StreamArray(m for k, m in msgs)
         yield from je.iterencode(kvars)
 
 def autolink(text, img=True):
@@ -682,7 +795,9 @@ def main(argv):
     parser.add_argument("-L", "--hardlimit", help="set a hard limit of the number of messages, must be used with -l", type=int, default=100000)
     parser.add_argument("-c", "--cachedir", help="the path of media files")
     parser.add_argument("-r", "--urlprefix", help="the url prefix of media files")
-    parser.add_argument("peer", help="export certain peer id or tg-cli-style peer print name")
+    parser.add_argument("-S", "--search", help="search the messages (see export.py --fts), in the FTS5 query syntax")
+    parser.add_argument("-C", "--context", help="number of messages shown before and after each search result", type=int, default=2)
+    parser.add_argument("peer", help="export certain peer id or tg-cli-style peer print name", nargs='?')
     args = parser.parse_args(argv)
 
     msg = Messages(stream=args.template.endswith('html'))
@@ -703,16 +818,29 @@ def main(argv):
         msg.init_db(args.db, 'cli')
     if args.botdb:
         msg.init_db(args.botdb, 'bot', args.botdb_user or not args.db, args.botdb_dest)
-    peer = msg.peers.find(args.peer)
-    if peer['id'] is None:
-        raise KeyError('peer not found: %s' % args.peer)
+    msgs = None
+    if args.peer:
+        peer = msg.peers.find(args.peer)
+        if peer['id'] is None:
+            raise KeyError('peer not found: %s' % args.peer)
+    elif args.search:
+        peer = None
+    else:
+        parser.error('the peer is required without --search')
+    if args.search:
+        msgs = msg.searchmsgs(args.search, peer, args.context)
+        if peer is None:
+            peer = {'id': None, 'type': 'search', 'print': 'Search: %s' % args.search}
     if args.output == '-':
-        for ln in render_func(peer, args.peer_print):
+        for ln in render_func(peer, args.peer_print, msgs):
             sys.stdout.write(ln)
     else:
         fn = args.output
         if args.output is None:
-            fn = '%s#id%d' % (peer['type'], peer['id'])
+            if args.search:
+                fn = 'search'
+            else:
+                fn = '%s#id%d' % (peer['type'], peer['id'])
             if args.template == 'json':
                 fn += '.json'
             elif '.' in args.template:
@@ -720,7 +848,7 @@ def main(argv):
             else:
                 fn += '.' + args.template
         with open(fn, 'w') as f:
-            for ln in render_func(peer, args.peer_print):
+            for ln in render_func(peer, args.peer_print, msgs):
                 f.write(ln)
 
 if __name__ == '__main__':
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of the storage of export.py.
+
+    python3 -m unittest test_export
+'''
+
+import os
+import tempfile
+import unittest
+
+import export
+
+class TestSearchBackfill(unittest.TestCase):
+    '''
+    The full-text index built over stored messages must have the rowids of
+    `messages`, also when their values are in `payloads` (`--dedup`).
+    '''
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        export.PAYLOADS = export.PayloadStore()
+        export.SEARCH = export.SearchIndex()
+        export.init_db(os.path.join(self.tmpdir.name, 'tg-export3.db'))
+        for n in range(1, 101):
+            text = ('message %d ' % n) * (1 + n % 30)
+            export.CONN.execute('INSERT INTO messages (id, src, dest, text, date) '
+                'VALUES (?,?,?,?,?)', (n, 4294967296 + 2, 4294967296 + 1, text, n))
+        # so that the rowids are not 1, 2, 3...
+        export.CONN.execute('DELETE FROM messages WHERE id % 3 = 0')
+
+    def tearDown(self):
+        export.DB.close()
+        self.tmpdir.cleanup()
+
+    def check_index(self):
+        fts = dict(export.CONN.execute('SELECT rowid, text FROM messages_fts'))
+        msgs = dict(export.CONN.execute('SELECT rowid, text FROM messages'))
+        self.assertEqual(sorted(fts), sorted(msgs))
+        for rowid, text in fts.items():
+            self.assertTrue(text.startswith('message %d ' % rowid))
+
+    def test_plain(self):
+        export.SEARCH.enable(export.CONN)
+        self.check_index()
+
+    def test_dedup(self):
+        self.assertGreater(export.PAYLOADS.enable(export.CONN, batch=7), 0)
+        export.SEARCH.enable(export.CONN)
+        self.check_index()
+
+if __name__ == '__main__':
+    unittest.main()
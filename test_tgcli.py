@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Tests of tgcli.py against the fake telegram-cli (fakecli.py).
+
+    python3 -m unittest test_tgcli
+'''
+
+import os
+import socket
+import asyncio
+import unittest
+
+import tgcli
+
+FAKECLI = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakecli.py')
+
+def fake_env(**settings):
+    env = os.environ.copy()
+    for k, v in settings.items():
+        env['TGFAKE_' + k] = str(v)
+    return env
+
+class TestLateAnswer(unittest.TestCase):
+    '''
+    The answer of a timed out command arrives after the timeout. It must
+    not be taken as the answer of the next command.
+    '''
+    env = fake_env(LATENCY=0.5, EVENTS=0)
+
+    def test_blocking(self):
+        with tgcli.TelegramCliInterface(FAKECLI, env=self.env) as tc:
+            with self.assertRaises(socket.timeout):
+                tc.send_command('get_self', timeout=0.1)
+            self.assertIsInstance(tc.send_command('contact_list', timeout=5), list)
+            self.assertIsInstance(tc.send_command('get_self', timeout=5), dict)
+
+    def test_async(self):
+        async def run():
+            async with tgcli.AsyncTelegramCliInterface(FAKECLI, env=self.env) as tc:
+                with self.assertRaises(asyncio.TimeoutError):
+                    await tc.send_command('get_self', timeout=0.1)
+                self.assertIsInstance(await tc.send_command('contact_list', timeout=5), list)
+                # cancelled instead of timed out
+                task = asyncio.ensure_future(tc.send_command('get_self', timeout=5))
+                await asyncio.sleep(0.1)
+                task.cancel()
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+                self.assertIsInstance(await tc.send_command('contact_list', timeout=5), list)
+                self.assertIsInstance(await tc.send_command('get_self', timeout=5), dict)
+
+        asyncio.run(run())
+
+if __name__ == '__main__':
+    unittest.main()
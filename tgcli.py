@@ -2,15 +2,21 @@
 # -*- coding: utf-8 -*-
 
 import os
+import zlib
 import time
 import json
+import bisect
 import socket
 import shutil
+import sqlite3
 import signal
+import asyncio
 import logging
 import tempfile
 import threading
 import subprocess
+import contextlib
+import collections
 
 '''
 tgcli.py - Library to interact with telegram-cli.
@@ -52,16 +58,416 @@ def preexec_ignore_sigint():
     '''
     signal.signal(signal.SIGINT, signal.SIG_IGN)
 
+def default_profile(env=None):
+    '''
+    The config directory of tg-cli, ~/.telegram-cli with the HOME of `env`.
+    '''
+    home = (env or os.environ).get('HOME', os.path.expanduser('~'))
+    return os.path.join(home, '.telegram-cli')
+
 class TelegramCliExited(RuntimeError):
     pass
 
+class Histogram:
+    '''
+    A histogram with fixed buckets, like the Prometheus one.
+    '''
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def prometheus(self, name, labels=''):
+        sep = ',' if labels else ''
+        cumulative = 0
+        for le, count in zip(self.buckets + ('+Inf',), self.counts):
+            cumulative += count
+            yield '%s_bucket{%s%sle="%s"} %d' % (name, labels, sep, le, cumulative)
+        labels = '{%s}' % labels if labels else ''
+        yield '%s_sum%s %.6f' % (name, labels, self.sum)
+        yield '%s_count%s %d' % (name, labels, self.count)
+
+class TelegramCliStats:
+    '''
+    Counters and latency histograms of the commands sent to telegram-cli,
+    and of its restarts. Can be written in Prometheus text format.
+    '''
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}
+        self.timeouts = collections.Counter()
+        self.exited = collections.Counter()
+        self.errors = collections.Counter()
+        self.resync_bytes = 0
+        self.restarts = collections.Counter()
+        self.ready_time = Histogram(self.buckets)
+        self.dump_thread = None
+
+    @staticmethod
+    def verb(cmd):
+        args = cmd.split(None, 1)
+        return args[0] if args else ''
+
+    def record(self, verb, seconds):
+        with self.lock:
+            hist = self.latency.get(verb)
+            if hist is None:
+                hist = self.latency[verb] = Histogram(self.buckets)
+            hist.observe(seconds)
+
+    def failed(self, verb, ex):
+        with self.lock:
+            if isinstance(ex, TelegramCliExited):
+                self.exited[verb] += 1
+            elif isinstance(ex, (socket.timeout, asyncio.TimeoutError)):
+                self.timeouts[verb] += 1
+            else:
+                self.errors[verb] += 1
+
+    @contextlib.contextmanager
+    def measure(self, cmd):
+        verb = self.verb(cmd)
+        start = time.monotonic()
+        try:
+            yield
+        except Exception as ex:
+            self.failed(verb, ex)
+            raise
+        self.record(verb, time.monotonic() - start)
+
+    def discarded(self, size):
+        with self.lock:
+            self.resync_bytes += size
+
+    def started(self, seconds, restart=None):
+        '''
+        Record the time to ready of a process. `restart` can be
+        None (first start), 'cold' or 'standby'.
+        '''
+        with self.lock:
+            self.ready_time.observe(seconds)
+            if restart:
+                self.restarts[restart] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'commands': {k: v.count for k, v in self.latency.items()},
+                'latency_sum': {k: v.sum for k, v in self.latency.items()},
+                'timeouts': dict(self.timeouts),
+                'exited': dict(self.exited),
+                'errors': dict(self.errors),
+                'resync_bytes': self.resync_bytes,
+                'restarts': dict(self.restarts),
+                'ready_time_sum': self.ready_time.sum,
+                'ready_time_count': self.ready_time.count
+            }
+
+    def prometheus(self):
+        lines = []
+
+        def counter(name, doc, values, label):
+            lines.append('# HELP %s %s' % (name, doc))
+            lines.append('# TYPE %s counter' % name)
+            for key, value in sorted(values.items()):
+                lines.append('%s{%s="%s"} %d' % (name, label, key, value))
+
+        with self.lock:
+            lines.append('# HELP tgcli_command_seconds Latency of successful commands.')
+            lines.append('# TYPE tgcli_command_seconds histogram')
+            for verb, hist in sorted(self.latency.items()):
+                lines.extend(hist.prometheus('tgcli_command_seconds', 'verb="%s"' % verb))
+            counter('tgcli_command_timeouts_total', 'Commands timed out.', self.timeouts, 'verb')
+            counter('tgcli_command_exited_total', 'Commands failed by telegram-cli exiting.', self.exited, 'verb')
+            counter('tgcli_command_errors_total', 'Commands failed otherwise.', self.errors, 'verb')
+            lines.append('# HELP tgcli_resync_discarded_bytes_total Bytes skipped to resync answers.')
+            lines.append('# TYPE tgcli_resync_discarded_bytes_total counter')
+            lines.append('tgcli_resync_discarded_bytes_total %d' % self.resync_bytes)
+            counter('tgcli_restarts_total', 'Restarts of telegram-cli.', self.restarts, 'kind')
+            lines.append('# HELP tgcli_ready_seconds Time from start or death to ready.')
+            lines.append('# TYPE tgcli_ready_seconds histogram')
+            lines.extend(self.ready_time.prometheus('tgcli_ready_seconds'))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, filename):
+        '''
+        Write the stats in Prometheus text format, atomically.
+        '''
+        tmpname = filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(self.prometheus())
+        os.replace(tmpname, filename)
+
+    def start_dump(self, filename, interval=30):
+        '''
+        Dump the stats to `filename` every `interval` seconds.
+        '''
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(filename)
+                except Exception:
+                    logger.exception('Failed to dump stats.')
+
+        self.dump_thread = threading.Thread(target=dump_loop)
+        self.dump_thread.daemon = True
+        self.dump_thread.start()
+
+class AdaptiveTimeout:
+    '''
+    Per-command timeouts learned from recent latencies: `margin` times the
+    `percentile` of the last `window` successful commands of the same verb,
+    bounded by `floor` and `ceiling`. Until there are `min_samples` of them,
+    `ceiling` is used.
+
+    After a timeout, the timeout of the verb is doubled until a command
+    of it succeeds, so that slow commands still get enough time. The latency
+    of that command is not learned, since it may include waiting for the
+    answer of the stuck one.
+    '''
+
+    def __init__(self, ceiling=60, floor=2, percentile=0.95, margin=3, window=200, min_samples=10):
+        self.ceiling = ceiling
+        self.floor = floor
+        self.percentile = percentile
+        self.margin = margin
+        self.window = window
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.backoff = collections.Counter()
+
+    def get(self, verb):
+        with self.lock:
+            samples = self.samples.get(verb)
+            if not samples or len(samples) < self.min_samples:
+                return self.ceiling
+            ordered = sorted(samples)
+            value = ordered[min(len(ordered) - 1, int(len(ordered) * self.percentile))]
+            timeout = value * self.margin * 2 ** self.backoff[verb]
+        return min(max(timeout, self.floor), self.ceiling)
+
+    def observe(self, verb, seconds):
+        with self.lock:
+            samples = self.samples.get(verb)
+            if samples is None:
+                samples = self.samples[verb] = collections.deque(maxlen=self.window)
+            if self.backoff.pop(verb, None) is None:
+                samples.append(seconds)
+
+    def timed_out(self, verb):
+        with self.lock:
+            self.backoff[verb] = min(self.backoff[verb] + 1, 8)
+
+    @contextlib.contextmanager
+    def track(self, verb):
+        start = time.monotonic()
+        try:
+            yield
+        except (socket.timeout, asyncio.TimeoutError):
+            self.timed_out(verb)
+            raise
+        self.observe(verb, time.monotonic() - start)
+
+class ResponseCache:
+    '''
+    On-disk cache of the answers of read-only tg-cli commands, in SQLite.
+    `ttl` maps command verbs to the seconds their answers are kept; other
+    commands are not cached. With `refresh`, cached answers are not used,
+    but new ones are still stored.
+    '''
+    ttl = {
+        'help': 7 * 86400,
+        'get_self': 86400,
+        'contact_list': 3600,
+        'dialog_list': 600,
+        'channel_get_members': 3600,
+        'chat_info': 3600,
+    }
+
+    def __init__(self, filename, ttl=None, refresh=False):
+        self.filename = filename
+        self.ttl = dict(self.ttl)
+        self.ttl.update(ttl or {})
+        self.refresh = refresh
+        self.hits = self.misses = 0
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS responses ('
+            'cmd TEXT PRIMARY KEY,'
+            'verb TEXT,'
+            'reply TEXT,'
+            'time REAL'
+        ')')
+        self.db.commit()
+
+    def get(self, cmd):
+        '''
+        Get the decoded answer of `cmd`, or None if it's not cached or expired.
+        '''
+        verb = TelegramCliStats.verb(cmd)
+        if self.refresh or verb not in self.ttl:
+            return None
+        with self.lock:
+            row = self.db.execute('SELECT reply FROM responses WHERE cmd=? AND time>?',
+                (cmd, time.time() - self.ttl[verb])).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        logger.debug('cached: %s', cmd)
+        return json.loads(row[0])
+
+    def put(self, cmd, result):
+        verb = TelegramCliStats.verb(cmd)
+        if verb not in self.ttl:
+            return
+        elif isinstance(result, dict) and result.get('result') == 'FAIL':
+            return
+        with self.lock:
+            self.db.execute('REPLACE INTO responses VALUES (?,?,?,?)',
+                (cmd, verb, json.dumps(result), time.time()))
+            self.db.commit()
+
+    def clear(self, verb=None):
+        with self.lock:
+            if verb is None:
+                self.db.execute('DELETE FROM responses')
+            else:
+                self.db.execute('DELETE FROM responses WHERE verb=?', (verb,))
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+class AnswerReader:
+    '''
+    Buffered reader for the socket interface of tg-cli.
+
+    Answers are framed as `ANSWER <size>\\n` followed by the payload.
+    The payload is received directly into a preallocated bytearray,
+    which `json.loads` can take without any further copies.
+    '''
+    chunk_size = 65536
+
+    def __init__(self, sock, ready, stats=None):
+        self.sock = sock
+        self.ready = ready
+        self.stats = stats
+        self.buffer = bytearray()
+        self.chunk = bytearray(self.chunk_size)
+
+    def _recv_into(self, buf):
+        if not self.ready.is_set():
+            # usually there is an assertion error
+            raise TelegramCliExited('telegram-cli unexpectedly exited.')
+        size = self.sock.recv_into(buf)
+        if not size:
+            raise TelegramCliExited('telegram-cli unexpectedly exited.')
+        return size
+
+    def readline(self):
+        pos = self.buffer.find(b'\n')
+        while pos == -1:
+            start = len(self.buffer)
+            size = self._recv_into(self.chunk)
+            self.buffer += memoryview(self.chunk)[:size]
+            pos = self.buffer.find(b'\n', start)
+        line = bytes(self.buffer[:pos+1])
+        del self.buffer[:pos+1]
+        return line
+
+    def read_payload(self, size):
+        '''
+        Read exactly `size` bytes, then the rest of the line if the
+        payload doesn't end with a newline.
+        '''
+        payload = bytearray(size)
+        with memoryview(payload) as view:
+            got = min(len(self.buffer), size)
+            with memoryview(self.buffer) as buffered:
+                view[:got] = buffered[:got]
+            del self.buffer[:got]
+            while got < size:
+                got += self._recv_into(view[got:])
+        if payload and payload[-1:] != b'\n':
+            payload += self.readline()
+        return payload
+
+    def read_answer(self, resync=True):
+        '''
+        Read an answer frame and return its payload.
+        use `resync` for skipping lines until the `ANSWER` header.
+        '''
+        line = self.readline()
+        skipped = 0
+        while resync and not line.startswith(b'ANSWER '):
+            skipped += len(line)
+            line = self.readline()
+        if skipped and self.stats:
+            self.stats.discarded(skipped)
+        return self.read_payload(int(line[7:]))
+
+class TelegramCliProcess:
+    '''
+    A telegram-cli process, with the connection to its socket.
+    '''
+
+    def __init__(self, proc, sockfile, home=None):
+        self.proc = proc
+        self.sockfile = sockfile
+        # the HOME with its own copy of the profile, removed when stopped
+        self.home = home
+        self.reader = None
+        self.spawn_time = time.monotonic()
+        # set on the first line on stdout, or on exit
+        self.started = threading.Event()
+        self.exited = threading.Event()
+        self.lock = threading.Lock()
+        self.active = False
+        # lines before the process becomes active
+        self.backlog = collections.deque()
+
 class TelegramCliInterface:
-    def __init__(self, cmd, extra_args=(), run=True, timeout=60, ignore_sigint=True):
+    # size of reads from stdout
+    pump_size = 65536
+
+    def __init__(self, cmd, extra_args=(), run=True, timeout=60, ignore_sigint=True, env=None, standby=False, adaptive_timeout=False, cache=None, profile=None):
         self.cmd = cmd
         self.extra_args = tuple(extra_args)
+        self.env = env
+        # the tg-cli config directory copied for the standby process,
+        # by default ~/.telegram-cli
+        self.profile = profile
+        # a ResponseCache for read-only commands
+        self.cache = cache
         self.proc = None
+        self.spawned = 0
+        # keep a started process to replace the active one when it dies
+        self.standby = standby
+        self.standby_proc = None
+        self.standby_thread = None
+        self.standby_lock = threading.Lock()
+        self.stats = TelegramCliStats()
+        # an AdaptiveTimeout, or None to use `timeout` for every command
+        self.timeouts = AdaptiveTimeout(timeout) if adaptive_timeout else None
+        self.handle = None
         self.sock = None
-        self.buffer = b''
+        self.sockfile = None
+        self.reader = None
+        # extra connections for `send_commands`
+        self.pipeline = []
         self.ready = threading.Event()
         self.closed = False
         self.thread = None
@@ -69,9 +475,11 @@ class TelegramCliInterface:
         self.timeout = timeout
         self.ignore_sigint = ignore_sigint
         # Event callbacks
-        # `on_info`, `on_json` and `on_text` are for stdout
+        # `on_info`, `on_json`, `on_json_batch` and `on_text` are for stdout
         self.on_info = logger.info
         self.on_json = logger.debug
+        # if set, called with a list of objects instead of `on_json`
+        self.on_json_batch = None
         self.on_text = do_nothing
         self.on_start = lambda: logger.info('Telegram-cli started.')
         self.on_exit = lambda: logger.warning('Telegram-cli died.')
@@ -96,60 +504,254 @@ class TelegramCliInterface:
                 f.write(tg_server_pub)
             return path
 
-    def checkproc(self):
-        if self.closed or self.proc and self.proc.poll() is None:
-            return self.proc
-        sockfile = os.path.join(self.tmpdir, 'tgcli.sock')
+    def _copy_profile(self, home):
+        '''
+        Copy the profile into `home`, and return the environment using it.
+        '''
+        env = dict(self.env or os.environ)
+        profile = self.profile or default_profile(env)
+        if os.path.isdir(profile):
+            shutil.copytree(profile, os.path.join(home, os.path.basename(profile.rstrip('/'))),
+                ignore=shutil.ignore_patterns('*.sock', 'downloads'))
+        else:
+            os.makedirs(home)
+        env['HOME'] = home
+        return env
+
+    def _spawn(self, copy_profile=False):
+        '''
+        Start a telegram-cli process and connect to its socket.
+        Return None if it exits before that.
+        With `copy_profile`, the process works on its own copy of the profile.
+        '''
+        self.spawned += 1
+        sockfile = os.path.join(self.tmpdir, 'tgcli%d.sock' % self.spawned)
         if os.path.exists(sockfile):
             os.unlink(sockfile)
-        self.proc = subprocess.Popen((self.cmd, '-k', self._get_pubkey(),
+        env = self.env
+        home = None
+        if copy_profile:
+            home = os.path.join(self.tmpdir, 'home%d' % self.spawned)
+            env = self._copy_profile(home)
+        handle = TelegramCliProcess(subprocess.Popen((self.cmd, '-k', self._get_pubkey(),
             '--json', '-R', '-C', '-S', sockfile) + self.extra_args,
             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            preexec_fn=preexec_ignore_sigint if self.ignore_sigint else None)
-        while not os.path.exists(sockfile):
-            time.sleep(0.5)
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.connect(sockfile)
-        return self.proc
+            stderr=subprocess.STDOUT, env=env,
+            preexec_fn=preexec_ignore_sigint if self.ignore_sigint else None), sockfile, home)
+        thread = threading.Thread(target=self._pump, args=(handle,))
+        thread.daemon = True
+        thread.start()
+        # the first line on stdout, or the exit
+        handle.started.wait()
+        delay = 0.01
+        while not handle.exited.is_set():
+            try:
+                handle.reader = self._connect(sockfile)
+                return handle
+            except (FileNotFoundError, ConnectionRefusedError):
+                handle.exited.wait(delay)
+                delay = min(delay * 2, 0.5)
+        self._stop(handle)
+        # eg. not logged in, or a wrong config
+        logger.warning('Telegram-cli exited on start with code %s.', handle.proc.returncode)
+        for line in handle.backlog or ():
+            logger.warning('%s', line.decode('utf-8', 'replace').rstrip())
 
-    def _run_cli(self):
-        while not self.closed:
-            self.checkproc()
+    def _stop(self, handle):
+        socks = [handle.reader.sock] if handle.reader else []
+        if handle.active:
+            socks.extend(r.sock for r in self.pipeline)
+        for sock in socks:
             try:
-                while not self.closed:
-                    out = self.proc.stdout.readline().decode('utf-8')
-                    if not out:
-                        break
-                    elif not self.ready.is_set():
-                        self.on_start()
-                        self.ready.set()
-                    self.on_text(out)
-                    if out[0] in '[{':
-                        try:
-                            self.on_json(json.loads(out.strip()))
-                        except ValueError:
-                            self.on_info(out.strip())
-                    else:
-                        self.on_info(out.strip())
-            except BrokenPipeError:
+                sock.shutdown(socket.SHUT_RDWR)
+            except Exception:
                 pass
-            finally:
+        if handle.proc.poll() is None:
+            handle.proc.terminate()
+            handle.proc.wait()
+        if handle.home:
+            shutil.rmtree(handle.home, True)
+
+    def _activate(self, handle):
+        self.handle = handle
+        self.proc = handle.proc
+        self.sockfile = handle.sockfile
+        self.close_pipeline()
+        self.reader = handle.reader
+        self.sock = handle.reader.sock
+        self.on_start()
+        self.ready.set()
+        # the callbacks may block, so they are called without the lock;
+        # new lines are kept after the backlog until it's dispatched
+        while True:
+            with handle.lock:
+                # None for a standby process
+                lines = handle.backlog
+                if not lines:
+                    handle.active = True
+                    break
+                handle.backlog = collections.deque()
+            self._dispatch(lines)
+
+    def _connect(self, sockfile=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(sockfile or self.sockfile)
+        except Exception:
+            sock.close()
+            raise
+        return AnswerReader(sock, self.ready, self.stats)
+
+    def close_pipeline(self, readers=None):
+        '''
+        Close the extra connections used by `send_commands`.
+        Their pending answers are dropped along with the connection.
+        '''
+        for reader in (self.pipeline if readers is None else readers):
+            try:
+                reader.sock.close()
+            except Exception:
+                pass
+        if readers is None:
+            self.pipeline = []
+        else:
+            self.pipeline = [r for r in self.pipeline if r not in readers]
+
+    def _dispatch(self, lines):
+        '''
+        Dispatch lines of stdout to the callbacks. With `on_json_batch`,
+        consecutive JSON lines are passed in one list.
+        '''
+        batch = []
+        for out in lines:
+            if self.on_text is not do_nothing:
+                self.on_text(out.decode('utf-8', 'replace') + '\n')
+            if out[:1] in (b'[', b'{'):
                 try:
-                    self.sock.shutdown(socket.SHUT_RDWR)
-                except Exception:
+                    obj = json.loads(out)
+                    if self.on_json_batch:
+                        batch.append(obj)
+                    else:
+                        self.on_json(obj)
+                    continue
+                except ValueError:
                     pass
-                if self.proc and self.proc.poll() is None:
-                    self.proc.terminate()
-                    self.proc.wait()
+            if batch:
+                self.on_json_batch(batch)
+                batch = []
+            self.on_info(out.decode('utf-8', 'replace').strip())
+        if batch:
+            self.on_json_batch(batch)
+
+    def _pump(self, handle):
+        '''
+        Read stdout of a process in chunks and split it into lines.
+        Lines are dispatched when the process is the active one, and kept
+        until then for a newly started process.
+        '''
+        buf = bytearray()
+        try:
+            while True:
+                chunk = handle.proc.stdout.read1(self.pump_size)
+                if not chunk:
+                    break
+                handle.started.set()
+                end = chunk.rfind(b'\n')
+                if end == -1:
+                    buf += chunk
+                    continue
+                buf += chunk[:end]
+                lines = buf.split(b'\n')
+                buf = bytearray(chunk[end+1:])
+                self._feed(handle, lines)
+            if buf:
+                self._feed(handle, [buf])
+        except (OSError, ValueError):
+            pass
+        finally:
+            with handle.lock:
+                if handle.active:
+                    self.ready.clear()
+            handle.started.set()
+            handle.exited.set()
+
+    def _feed(self, handle, lines):
+        with handle.lock:
+            if not handle.active:
+                if handle.backlog is not None:
+                    handle.backlog.extend(lines)
+                return
+        # an active process stays active
+        self._dispatch(lines)
+
+    def _prepare_standby(self):
+        # it runs along with the active one, which writes to the profile
+        handle = self._spawn(copy_profile=True)
+        if handle is None:
+            return
+        # its output duplicates the active one
+        handle.backlog = None
+        with self.standby_lock:
+            if self.closed or self.standby_proc:
+                self._stop(handle)
+            else:
+                self.standby_proc = handle
+
+    def _take_standby(self):
+        with self.standby_lock:
+            handle, self.standby_proc = self.standby_proc, None
+        if handle and handle.exited.is_set():
+            self._stop(handle)
+            return None
+        return handle
+
+    def _run_cli(self):
+        died = None
+        # between failed starts
+        delay = 0
+        while not self.closed:
+            handle = self._take_standby()
+            from_standby = handle is not None
+            if handle is None:
+                handle = self._spawn()
+                if handle is None:
+                    delay = min(delay * 2 or 0.5, 60)
+                    logger.info('Starting telegram-cli again in %g s.', delay)
+                    time.sleep(delay)
+                    continue
+            delay = 0
+            if self.closed:
+                self._stop(handle)
+                break
+            self._activate(handle)
+            if died is None:
+                elapsed = time.monotonic() - handle.spawn_time
+                logger.info('Telegram-cli ready in %.3f s.', elapsed)
+                self.stats.started(elapsed)
+            else:
+                elapsed = time.monotonic() - died
+                logger.info('Telegram-cli restarted in %.3f s%s.', elapsed,
+                            ' (standby)' if from_standby else '')
+                self.stats.started(elapsed, 'standby' if from_standby else 'cold')
+            if self.standby and not (self.standby_thread and self.standby_thread.is_alive()):
+                self.standby_thread = threading.Thread(target=self._prepare_standby)
+                self.standby_thread.daemon = True
+                self.standby_thread.start()
+            handle.exited.wait()
+            died = time.monotonic()
+            self._stop(handle)
             self.ready.clear()
             self.on_exit()
+        handle = self._take_standby()
+        if handle:
+            self._stop(handle)
 
-    def run(self):
+    def run(self, wait=True):
         self.thread = threading.Thread(target=self._run_cli)
         self.thread.daemon = True
         self.thread.start()
-        self.ready.wait()
+        if wait:
+            self.ready.wait()
 
     def restart(self):
         self.close()
@@ -162,10 +764,15 @@ class TelegramCliInterface:
             return
         self.closed = True
         self.ready.clear()
+        handle = self._take_standby()
+        if handle:
+            self._stop(handle)
         try:
             self.proc.wait(2)
         except subprocess.TimeoutExpired:
             self.proc.kill()
+        except AttributeError:
+            pass
         if self.thread:
             self.thread.join(1)
         if os.path.isdir(self.tmpdir):
@@ -184,38 +791,139 @@ class TelegramCliInterface:
     def __del__(self):
         self.close()
 
-    def _readline(self):
-        while self.ready.is_set():
-            lines = self.buffer.split(b'\n', 1)
-            if len(lines) > 1:
-                self.buffer = lines[1]
-                return lines[0] + b'\n'
-            else:
-                self.buffer += self.sock.recv(1024)
-        # usually there is an assertion error
-        raise TelegramCliExited('telegram-cli unexpectedly exited.')
-
-    def send_command(self, cmd, timeout=None, resync=True):
+    def send_command(self, cmd, timeout=None, resync=True, cache=True):
         '''
         Send a command to tg-cli.
         use `resync` for consuming text since last timeout.
+        With `cache`, the answer may come from `self.cache`.
         '''
+        if cache and self.cache:
+            result = self.cache.get(cmd)
+            if result is not None:
+                return result
+            result = self.send_command(cmd, timeout, resync, False)
+            self.cache.put(cmd, result)
+            return result
         logger.debug(cmd)
         self.ready.wait()
-        self.sock.settimeout(timeout or self.timeout)
-        self.sock.sendall(cmd.encode('utf-8') + b'\n')
-        line = self._readline()
-        while resync and not line.startswith(b'ANSWER '):
-            line = self._readline()
-        size = int(line[7:].decode('ascii'))
-        reply = b''
-        while len(reply) < size:
-            reply += self._readline()
-        ret = reply.decode('utf-8')
+        handle = self.handle
+        verb = self.stats.verb(cmd)
+        with self.stats.measure(cmd), self._track(verb):
+            try:
+                handle.reader.sock.settimeout(timeout or self.get_timeout(verb))
+                handle.reader.sock.sendall(cmd.encode('utf-8') + b'\n')
+                reply = handle.reader.read_answer(resync)
+            except socket.timeout:
+                self._abandon(handle)
+                raise
+            except (BrokenPipeError, ConnectionResetError, TelegramCliExited):
+                self._wait_exit(handle)
+        return self._decode(reply)
+
+    def _abandon(self, handle):
+        '''
+        Leave the stuck command on its own connection and use a new one,
+        so the next command doesn't wait behind it or get its late answer.
+        '''
+        old = handle.reader
         try:
-            return json.loads(ret)
+            handle.reader = self._connect(handle.sockfile)
+        except OSError:
+            return
+        if self.handle is handle:
+            self.reader = handle.reader
+            self.sock = handle.reader.sock
+        try:
+            old.sock.close()
+        except Exception:
+            pass
+
+    def send_commands(self, cmds, timeout=None, resync=True, depth=4):
+        '''
+        Send a list of commands to tg-cli, keeping up to `depth` of them
+        in flight, and return the answers in order.
+
+        tg-cli answers queries on one connection in the order they finish,
+        so each command in flight gets its own connection to the socket.
+        If anything goes wrong, the connections with pending answers are
+        closed, so late answers can't be mistaken for later ones.
+        '''
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        self.ready.wait()
+        handle = self.handle
+        depth = max(1, min(depth, len(cmds)))
+        try:
+            while len(self.pipeline) < depth:
+                self.pipeline.append(self._connect())
+        except OSError:
+            self._wait_exit(handle)
+        readers = self.pipeline[:depth]
+
+        # reader -> (verb, time sent)
+        pending = {}
+
+        def submit(reader, cmd):
+            logger.debug(cmd)
+            verb = self.stats.verb(cmd)
+            pending[reader] = (verb, time.monotonic())
+            reader.sock.settimeout(timeout or self.get_timeout(verb))
+            reader.sock.sendall(cmd.encode('utf-8') + b'\n')
+
+        results = []
+        try:
+            for reader, cmd in zip(readers, cmds):
+                submit(reader, cmd)
+            for k in range(len(cmds)):
+                reader = readers[k % depth]
+                reply = reader.read_answer(resync)
+                verb, start = pending.pop(reader)
+                self.stats.record(verb, time.monotonic() - start)
+                if self.timeouts:
+                    self.timeouts.observe(verb, time.monotonic() - start)
+                results.append(self._decode(reply))
+                if k + depth < len(cmds):
+                    submit(reader, cmds[k + depth])
+        except (BrokenPipeError, ConnectionResetError, TelegramCliExited) as ex:
+            self._pipeline_failed(pending, ex)
+            self._wait_exit(handle)
+        except Exception as ex:
+            self._pipeline_failed(pending, ex)
+            raise
+        return results
+
+    def _pipeline_failed(self, pending, ex):
+        for verb, start in pending.values():
+            self.stats.failed(verb, ex)
+            if self.timeouts and isinstance(ex, socket.timeout):
+                self.timeouts.timed_out(verb)
+        self.close_pipeline(pending)
+
+    def get_timeout(self, verb):
+        if self.timeouts:
+            return self.timeouts.get(verb)
+        return self.timeout
+
+    def _track(self, verb):
+        if self.timeouts:
+            return self.timeouts.track(verb)
+        return contextlib.nullcontext()
+
+    def _wait_exit(self, handle):
+        '''
+        The connection is lost: wait for the process to be noticed dead,
+        so that the next command goes to the new one.
+        '''
+        handle.exited.wait(self.timeout)
+        raise TelegramCliExited('telegram-cli unexpectedly exited.')
+
+    @staticmethod
+    def _decode(reply):
+        try:
+            return json.loads(reply)
         except ValueError:
-            return ret
+            return reply.decode('utf-8')
 
     def __getattr__(self, name):
         '''
@@ -230,6 +938,354 @@ class TelegramCliInterface:
         else:
             raise AttributeError('TelegramCliInterface has no attribute %r' % name)
 
+class TelegramCliPool:
+    '''
+    A pool of telegram-cli processes with the same `send_command` and
+    `cmd_*` interface as `TelegramCliInterface`.
+
+    Commands are routed by their first argument (usually a peer), so the
+    commands for one peer go to the same process. Members restart their
+    processes by themselves; meanwhile, commands go to the next ready one.
+
+    Each member gets a copy of `profile` (a tg-cli config directory, by
+    default ~/.telegram-cli) in its own HOME, so the original is only read
+    and the members don't write to the same state files.
+    '''
+
+    def __init__(self, cmd, size=2, extra_args=(), run=True, timeout=60, ignore_sigint=True, profile=None, standby=False, adaptive_timeout=False, cache=None):
+        profile = profile or default_profile()
+        self.members = [TelegramCliInterface(cmd, extra_args, False, timeout, ignore_sigint, standby=standby, profile=profile)
+                        for k in range(size)]
+        self.locks = [threading.Lock() for k in range(size)]
+        self.stats = TelegramCliStats()
+        self.timeouts = AdaptiveTimeout(timeout) if adaptive_timeout else None
+        self.cache = cache
+        for member in self.members:
+            member.stats = self.stats
+            member.timeouts = self.timeouts
+        self.profile = profile
+        self.ready = threading.Event()
+        self.closed = False
+        self.counter = 0
+        self.on_info = logger.info
+        self.on_json = logger.debug
+        self.on_json_batch = None
+        self.on_text = do_nothing
+        self.on_start = lambda: logger.info('Telegram-cli started.')
+        self.on_exit = lambda: logger.warning('Telegram-cli died.')
+        for member in self.members:
+            member.on_info = lambda s: self.on_info(s)
+            member.on_json = lambda obj: self.on_json(obj)
+            member.on_json_batch = self._member_json_batch
+            member.on_text = lambda s: self.on_text(s)
+            member.on_start = self._member_started
+            member.on_exit = self._member_exited
+        if run:
+            self.run()
+
+    def _member_json_batch(self, objs):
+        if self.on_json_batch:
+            self.on_json_batch(objs)
+        else:
+            for obj in objs:
+                self.on_json(obj)
+
+    def _member_started(self):
+        self.on_start()
+        self.ready.set()
+
+    def _member_exited(self):
+        if not any(m.ready.is_set() for m in self.members):
+            self.ready.clear()
+        self.on_exit()
+
+    def _copy_profile(self, member):
+        home = os.path.join(member.tmpdir, 'home')
+        dest = os.path.join(home, os.path.basename(self.profile.rstrip('/')))
+        if not os.path.isdir(self.profile):
+            os.makedirs(home, exist_ok=True)
+        elif not os.path.isdir(dest):
+            shutil.copytree(self.profile, dest, ignore=shutil.ignore_patterns('*.sock', 'downloads'))
+        env = os.environ.copy()
+        env['HOME'] = home
+        member.env = env
+
+    def run(self):
+        for member in self.members:
+            self._copy_profile(member)
+            member.run(False)
+        for member in self.members:
+            member.ready.wait()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.ready.clear()
+        for member in self.members:
+            member.close()
+
+    def __enter__(self):
+        if not self.members[0].thread:
+            self.run()
+        self.ready.wait()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def route(self, key=None):
+        '''
+        Get the index of the member for `key`. Without a key, the members
+        are used in turn.
+        '''
+        size = len(self.members)
+        if key is None:
+            self.counter += 1
+            start = self.counter % size
+        else:
+            start = zlib.crc32(str(key).encode('utf-8')) % size
+        for k in range(size):
+            index = (start + k) % size
+            if self.members[index].ready.is_set():
+                return index
+        return start
+
+    @staticmethod
+    def _key(cmd):
+        args = cmd.split(None, 2)
+        if len(args) > 1:
+            return args[1]
+
+    def send_command(self, cmd, timeout=None, resync=True, cache=True):
+        if cache and self.cache:
+            result = self.cache.get(cmd)
+            if result is not None:
+                return result
+        index = self.route(self._key(cmd))
+        with self.locks[index]:
+            result = self.members[index].send_command(cmd, timeout, resync, False)
+        if cache and self.cache:
+            self.cache.put(cmd, result)
+        return result
+
+    def send_commands(self, cmds, timeout=None, resync=True, depth=4):
+        cmds = list(cmds)
+        if not cmds:
+            return []
+        index = self.route(self._key(cmds[0]))
+        with self.locks[index]:
+            return self.members[index].send_commands(cmds, timeout, resync, depth)
+
+    def __getattr__(self, name):
+        if name.startswith('cmd_'):
+            fn = lambda *args, **kwargs: self.send_command(
+                ' '.join(map(str, (name[4:],) + args)), **kwargs)
+            return fn
+        else:
+            raise AttributeError('TelegramCliPool has no attribute %r' % name)
+
+class AsyncTelegramCliInterface:
+    '''
+    asyncio version of `TelegramCliInterface`.
+
+        async with AsyncTelegramCliInterface(cmd) as tgcli:
+            dialogs = await tgcli.cmd_dialog_list()
+            async for obj in tgcli.events():
+                ...
+
+    JSON lines printed on stdout are put in a queue and can be consumed
+    with `events()`, other lines go to `on_info`. Commands are serialized
+    on the socket; if one times out or is cancelled, its connection is
+    closed and the next command opens a new one, so that it doesn't get
+    the late answer, like in `TelegramCliInterface`.
+    '''
+    # limit of a line on stdout
+    line_limit = 1 << 24
+
+    def __init__(self, cmd, extra_args=(), timeout=60, ignore_sigint=True, env=None, queue_size=0, adaptive_timeout=False, cache=None):
+        self.cmd = cmd
+        self.extra_args = tuple(extra_args)
+        self.timeout = timeout
+        self.ignore_sigint = ignore_sigint
+        self.env = env
+        self.queue_size = queue_size
+        self.proc = None
+        self.sockfile = None
+        self.reader = None
+        self.writer = None
+        self.ready = None
+        self.lock = None
+        self.queue = None
+        self.task = None
+        self.closed = False
+        self.tmpdir = tempfile.mkdtemp()
+        self.stats = TelegramCliStats()
+        self.timeouts = AdaptiveTimeout(timeout) if adaptive_timeout else None
+        self.cache = cache
+        self.on_info = logger.info
+        self.on_start = lambda: logger.info('Telegram-cli started.')
+        self.on_exit = lambda: logger.warning('Telegram-cli died.')
+
+    _get_pubkey = TelegramCliInterface._get_pubkey
+    _decode = staticmethod(TelegramCliInterface._decode)
+    get_timeout = TelegramCliInterface.get_timeout
+    _track = TelegramCliInterface._track
+
+    async def run(self):
+        self.ready = asyncio.Event()
+        self.lock = asyncio.Lock()
+        self.queue = asyncio.Queue(self.queue_size)
+        self.task = asyncio.ensure_future(self._run_cli())
+        await self.ready.wait()
+
+    async def _spawn(self):
+        sockfile = self.sockfile = os.path.join(self.tmpdir, 'tgcli.sock')
+        if os.path.exists(sockfile):
+            os.unlink(sockfile)
+        self.proc = await asyncio.create_subprocess_exec(self.cmd, '-k', self._get_pubkey(),
+            '--json', '-R', '-C', '-S', sockfile, *self.extra_args,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT, env=self.env, limit=self.line_limit,
+            preexec_fn=preexec_ignore_sigint if self.ignore_sigint else None)
+        while not os.path.exists(sockfile):
+            if self.proc.returncode is not None:
+                return
+            await asyncio.sleep(0.5)
+        self.reader, self.writer = await asyncio.open_unix_connection(sockfile)
+
+    async def _run_cli(self):
+        while not self.closed:
+            try:
+                await self._spawn()
+                while not self.closed:
+                    out = await self.proc.stdout.readline()
+                    if not out:
+                        break
+                    elif not self.ready.is_set():
+                        self.on_start()
+                        self.ready.set()
+                    if out[:1] in (b'[', b'{'):
+                        try:
+                            await self.queue.put(json.loads(out))
+                            continue
+                        except ValueError:
+                            pass
+                    self.on_info(out.decode('utf-8', 'replace').strip())
+            except (OSError, ValueError):
+                logger.exception('Failed to read from telegram-cli.')
+            finally:
+                if self.writer:
+                    self.writer.close()
+                if self.proc and self.proc.returncode is None:
+                    self.proc.terminate()
+                    await self.proc.wait()
+            self.ready.clear()
+            self.on_exit()
+
+    async def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.proc and self.proc.returncode is None:
+            self.proc.terminate()
+            try:
+                await asyncio.wait_for(self.proc.wait(), 2)
+            except asyncio.TimeoutError:
+                self.proc.kill()
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.tmpdir and os.path.isdir(self.tmpdir):
+            shutil.rmtree(self.tmpdir, True)
+            self.tmpdir = None
+
+    async def __aenter__(self):
+        if not self.task:
+            await self.run()
+        await self.ready.wait()
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+
+    async def events(self):
+        '''
+        Iterate over the JSON objects printed on stdout.
+        '''
+        while not self.closed:
+            yield await self.queue.get()
+
+    async def _read_answer(self, resync=True):
+        try:
+            line = await self.reader.readline()
+            while resync and line and not line.startswith(b'ANSWER '):
+                line = await self.reader.readline()
+            if not line:
+                raise TelegramCliExited('telegram-cli unexpectedly exited.')
+            reply = await self.reader.readexactly(int(line[7:]))
+            if reply and reply[-1:] != b'\n':
+                reply += await self.reader.readline()
+            return reply
+        except asyncio.IncompleteReadError:
+            raise TelegramCliExited('telegram-cli unexpectedly exited.')
+
+    def _abandon(self):
+        '''
+        Close the connection of a stuck command, so that the next command
+        uses a new one and doesn't get its late answer.
+        '''
+        if self.writer:
+            self.writer.close()
+        self.reader = self.writer = None
+
+    async def _send_command(self, cmd, resync):
+        await self.ready.wait()
+        async with self.lock:
+            if self.writer is None:
+                try:
+                    self.reader, self.writer = await asyncio.open_unix_connection(self.sockfile)
+                except OSError:
+                    raise TelegramCliExited('telegram-cli unexpectedly exited.')
+            try:
+                self.writer.write(cmd.encode('utf-8') + b'\n')
+                await self.writer.drain()
+                return await self._read_answer(resync)
+            except asyncio.CancelledError:
+                # timed out in `send_command`, or cancelled
+                self._abandon()
+                raise
+
+    async def send_command(self, cmd, timeout=None, resync=True, cache=True):
+        '''
+        Send a command to tg-cli, raise `asyncio.TimeoutError` after `timeout`.
+        use `resync` for consuming text since last timeout.
+        With `cache`, the answer may come from `self.cache`.
+        '''
+        if cache and self.cache:
+            result = self.cache.get(cmd)
+            if result is not None:
+                return result
+        logger.debug(cmd)
+        verb = self.stats.verb(cmd)
+        with self.stats.measure(cmd), self._track(verb):
+            reply = await asyncio.wait_for(self._send_command(cmd, resync), timeout or self.get_timeout(verb))
+        result = self._decode(reply)
+        if cache and self.cache:
+            self.cache.put(cmd, result)
+        return result
+
+    def __getattr__(self, name):
+        if name.startswith('cmd_'):
+            fn = lambda *args, **kwargs: self.send_command(
+                ' '.join(map(str, (name[4:],) + args)), **kwargs)
+            return fn
+        else:
+            raise AttributeError('AsyncTelegramCliInterface has no attribute %r' % name)
+
 if __name__ == "__main__":
     import sys
     logging.basicConfig(stream=sys.stderr, format='%(asctime)s [%(levelname)s] %(message)s', level=logging.INFO)